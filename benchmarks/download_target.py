@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+# Time per book to get the url and the file path to download it to, the
+# regexes Scraper._run_download_all compiled for every book against
+# ebook_dl.download_target.parse, which runs once per book when its tn_url
+# is resolved. The download stage itself now only reads the stored target.
+#
+#   python benchmarks/download_target.py [count]
+
+import os
+import re
+import sys
+import timeit
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ebook_dl import download_target
+
+_MAIN_URL = 'https://itebooksfree.com/'
+_URL_THAT_WONT_WORK = 'http://file.allitebooks.com'
+_OUTPUT_DIR = 'output'
+
+
+def regex_job(resource_url):
+    # The loop body of Scraper._run_download_all as it was, returning what
+    # it handed to _download_from_url_and_save. The path was quoted for the
+    # shell running axel.
+    if resource_url.startswith(_URL_THAT_WONT_WORK):
+        return None
+    if resource_url.startswith('/'):
+        resource_url = _MAIN_URL + resource_url[1:]
+        filename_regex = re.compile('^.+/(.+)$')
+        date_code_regex = re.compile('^.+/(.+)/.*$')
+        date_code_2_regex = re.compile('^.+/(.*)//.*$')
+        prefix_regex = re.compile('^(.+)/.*$')
+        filename = filename_regex.findall(resource_url)[0]
+        date_code = date_code_regex.findall(resource_url)[0]
+        if date_code == '':
+            date_code = date_code_2_regex.findall(resource_url)[0]
+        quoted_resource_url = ''.join([
+            prefix_regex.findall(resource_url)[0],
+            '/',
+            quote(filename)
+        ])
+        file_path = ''.join([
+            _OUTPUT_DIR,
+            '/',
+            '"',
+            date_code,
+            ' ',
+            filename,
+            '"',
+        ])
+        return quoted_resource_url, file_path
+    return None
+
+
+def parse_job(resource_url):
+    target = download_target.parse(resource_url, _MAIN_URL, _OUTPUT_DIR)
+    return None if target is None else (target.url, target.file_path)
+
+
+def stored_job(target):
+    return target.url, target.file_path
+
+
+def run(job, items):
+    for item in items:
+        job(item)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    resource_urls = [
+        f'/file/2019/{i % 12 + 1:02d}/{i % 28 + 1:02d}/Book Title {i} (2nd Edition).pdf'
+        for i in range(count)
+    ]
+    for resource_url in resource_urls[:100]:
+        url, file_path = regex_job(resource_url)
+        assert (url, file_path.replace('"', '')) == parse_job(resource_url), resource_url
+    targets = [download_target.parse(resource_url, _MAIN_URL, _OUTPUT_DIR) for resource_url in resource_urls]
+    results = [
+        ('regexes per book', min(timeit.repeat(lambda: run(regex_job, resource_urls), number=1, repeat=3))),
+        ('download_target.parse', min(timeit.repeat(lambda: run(parse_job, resource_urls), number=1, repeat=3))),
+        ('stored target', min(timeit.repeat(lambda: run(stored_job, targets), number=1, repeat=3))),
+    ]
+    print(f'{count} resource urls')
+    for name, seconds in results:
+        print(f'  {name:<22} {seconds / count * 1e6:8.3f} us/book {seconds:8.3f} s')
+
+
+if __name__ == '__main__':
+    main()
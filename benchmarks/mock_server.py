@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+# A local stand-in for itebooksfree.com serving synthetic listing pages,
+# profile pages, /download/<tn_url> json and book files, so the scraper can
+# be measured without touching the live site.
+#
+#   python benchmarks/mock_server.py --port 8765 --pages 20 --latency 50
+
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+_LISTING_PATTERN = re.compile(r'^/(?:search/[^/]+/?)?(?:page/)?(\d+)?/?$')
+_PROFILE_PATTERN = re.compile(r'^/book/([^/]+)/(\d+)$')
+_DOWNLOAD_PATTERN = re.compile(r'^/download/tn(\d+)$')
+_FILE_PATTERN = re.compile(r'^/files/(\d+)/[^/]+$')
+_RANGE_PATTERN = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class MockSite:
+
+    def __init__(self, pages, per_page, file_size, latency, error_rate, seed):
+        self.pages = pages
+        self.per_page = per_page
+        self.file_size = file_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.file_body = bytes(range(256)) * (file_size // 256 + 1)
+        self.lock = threading.Lock()
+        self.counts = {}
+
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+
+    def listing_page(self, page):
+        cards = ''.join(
+            f'<div class="card"><div class="card-body">'
+            f'<a href="/book/book-{page}-{i}/{page * self.per_page + i}">Book {page}-{i}</a>'
+            f'<p>{"filler text " * 20}</p></div></div>'
+            for i in range(self.per_page)
+        )
+        return (
+            f'<html><head><title>Page {page}</title></head><body>'
+            f'<nav>{"<a href=/>menu</a>" * 30}</nav>{cards}'
+            f'<div class="pagination"><span class="text">1 / {self.pages} Pages</span></div>'
+            f'</body></html>'
+        )
+
+
+    def profile_page(self, name, book_id):
+        bodies = ''.join(
+            f'<div class="body"><p>Paragraph {k} about <b>{name}</b>. {"More text. " * 30}</p></div>'
+            for k in range(6)
+        )
+        return (
+            f'<html><head><title>{name}</title></head><body><nav>{"<a href=/>menu</a>" * 30}</nav>'
+            f'<section class="content"><h3 class="product-title">Title of {name}</h3>'
+            f'<div class="details"><ul class="list-unstyled"><li>Year: 2020</li><li>Pages: 300</li></ul></div>'
+            f'{bodies}<span class="tn-download" tn-url="tn{book_id}"></span></section>'
+            f'</body></html>'
+        )
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    site = None
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def _send(self, status, body, content_type='text/html; charset=utf-8', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def _send_page(self, text):
+        body = text.encode('utf-8')
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.site.count('not_modified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self._send(200, body, headers={'ETag': etag})
+
+
+    def _send_file(self):
+        size = self.site.file_size
+        range_header = self.headers.get('Range')
+        match = _RANGE_PATTERN.match(range_header) if range_header else None
+        if match is None:
+            self._send(200, self.site.file_body[:size], 'application/pdf', {'Accept-Ranges': 'bytes'})
+            return
+        first_byte = int(match.group(1))
+        last_byte = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        self._send(206, self.site.file_body[first_byte:last_byte + 1], 'application/pdf', {
+            'Accept-Ranges': 'bytes',
+            'Content-Range': f'bytes {first_byte}-{last_byte}/{size}',
+        })
+
+
+    def do_GET(self):
+        path = re.sub('/+', '/', self.path.split('?')[0])
+        if path == '/stats':
+            self._send(200, json.dumps(self.site.counts).encode('utf-8'), 'application/json')
+            return
+        if self.site.latency:
+            time.sleep(self.site.latency)
+        if self.site.should_fail():
+            self.site.count('error')
+            self._send(503, b'busy', headers={'Retry-After': '0'})
+            return
+        match = _LISTING_PATTERN.match(path)
+        if match:
+            self.site.count('listing')
+            page = int(match.group(1) or 1)
+            if page > self.site.pages:
+                self._send(404, b'not found')
+                return
+            self._send_page(self.site.listing_page(page))
+            return
+        match = _PROFILE_PATTERN.match(path)
+        if match:
+            self.site.count('profile')
+            self._send_page(self.site.profile_page(match.group(1), match.group(2)))
+            return
+        match = _DOWNLOAD_PATTERN.match(path)
+        if match:
+            self.site.count('download')
+            book_id = match.group(1)
+            body = json.dumps({'ok': True, 'url': f'/files/{book_id}/book {book_id}.pdf'})
+            self._send(200, body.encode('utf-8'), 'application/json')
+            return
+        if _FILE_PATTERN.match(path):
+            self.site.count('file')
+            self._send_file()
+            return
+        self._send(404, b'not found')
+
+
+class MockServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+
+    def handle_error(self, request, client_address):
+        # Clients dropping idle keep-alive connections are not errors.
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--port', type=int, default=0, help='0 picks a free port')
+    arg_parser.add_argument('--pages', type=int, default=20)
+    arg_parser.add_argument('--per-page', type=int, default=10)
+    arg_parser.add_argument('--file-size', type=int, default=256 * 1024, help='bytes per book file')
+    arg_parser.add_argument('--latency', type=float, default=0.0, help='milliseconds added to every response')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of responses that are 503')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+    MockHandler.site = MockSite(
+        args.pages, args.per_page, args.file_size,
+        args.latency / 1000, args.error_rate, args.seed,
+    )
+    server = MockServer(('127.0.0.1', args.port), MockHandler)
+    print(f'listening on http://127.0.0.1:{server.server_address[1]}/', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
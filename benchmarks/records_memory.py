@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+# Memory held by 100k BookInfo and BookUrl records, the slotted records of
+# ebook_dl.db against the dict based ones they replaced.
+#
+#   python benchmarks/records_memory.py [count]
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ebook_dl.db import BookInfo, BookUrl
+
+
+class DictBookInfo:
+    def __init__(self):
+        self.id = ''
+        self.title = ''
+        self.details = ''
+        self.description = ''
+        self.tn_url = []
+        self.resource_url = []
+        self.profile_url = ''
+
+
+class DictBookUrl:
+    def __init__(self, id='', book_id='', tn_url='', resource_url=''):
+        self.id = id
+        self.book_id = book_id
+        self.tn_url = tn_url
+        self.resource_url = resource_url
+
+
+def make_dict_records(count, strings):
+    records = []
+    for i in range(count):
+        book_info = DictBookInfo()
+        book_info.id = i
+        book_info.title, book_info.details, book_info.description, tn_url, book_info.profile_url = strings[i]
+        book_info.tn_url.append(tn_url)
+        records.append(book_info)
+        records.append(DictBookUrl(i, i, tn_url, ''))
+    return records
+
+
+def make_slotted_records(count, strings):
+    records = []
+    for i in range(count):
+        title, details, description, tn_url, profile_url = strings[i]
+        records.append(BookInfo(i, title, details, description, tn_url, profile_url))
+        records.append(BookUrl.from_row((i, i, tn_url, '')))
+    return records
+
+
+def measure(make_records, count, strings):
+    tracemalloc.start()
+    records = make_records(count, strings)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    # The strings are shared by both runs, only the record overhead is
+    # measured.
+    strings = [
+        (f'title {i}', 'details', 'description', f'tn{i}', f'/book/title-{i}/{i}')
+        for i in range(count)
+    ]
+    dict_size = measure(make_dict_records, count, strings)
+    slotted_size = measure(make_slotted_records, count, strings)
+    print(f'{count} BookInfo + {count} BookUrl records')
+    print(f'  dict based: {dict_size / 1024 / 1024:8.1f} MiB')
+    print(f'  slotted:    {slotted_size / 1024 / 1024:8.1f} MiB')
+    print(f'  saved:      {(1 - slotted_size / dict_size) * 100:8.1f} %')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+# Runs the cli stages end to end against benchmarks/mock_server.py and
+# reports responses/s (as counted by the server), request latency, cpu time
+# and peak rss per stage.
+# Every stage runs in a process of its own, in a scratch directory holding
+# the db and the downloaded files.
+#
+#   python benchmarks/run_stages.py --pages 50 --latency 20 --error-rate 0.01
+#   python benchmarks/run_stages.py --stages search collect-book-info -- --engine async
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+
+_BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+_REPO_DIR = os.path.dirname(_BENCHMARKS_DIR)
+_STAGES = ('search', 'collect-book-info', 'resource-url', 'download-all')
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+def run_child(result_path, cli_args):
+    # Runs one stage in this process, timing every request of the shared
+    # session (the async engine does not go through it, its latencies are
+    # not reported).
+    sys.path.insert(0, _REPO_DIR)
+    from ebook_dl import config
+    from ebook_dl import session
+    from ebook_dl.main import app
+
+    latencies = []
+    get = session.get
+
+    def timed_get(url, **kwargs):
+        start = time.perf_counter()
+        try:
+            return get(url, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    session.get = timed_get
+    config.init()
+    config.config_logging()
+    start = time.perf_counter()
+    app(args=cli_args, standalone_mode=False)
+    wall_time = time.perf_counter() - start
+    latencies.sort()
+    with open(result_path, 'w') as result_file:
+        json.dump({
+            'wall_time': wall_time,
+            'requests': len(latencies),
+            'p50': _percentile(latencies, 0.5),
+            'p99': _percentile(latencies, 0.99),
+        }, result_file)
+
+
+def start_mock_server(args):
+    process = subprocess.Popen(
+        [
+            sys.executable, os.path.join(_BENCHMARKS_DIR, 'mock_server.py'),
+            '--pages', str(args.pages),
+            '--per-page', str(args.per_page),
+            '--file-size', str(args.file_size),
+            '--latency', str(args.latency),
+            '--error-rate', str(args.error_rate),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    main_url = process.stdout.readline().split()[-1]
+    return process, main_url
+
+
+def _served_counts(main_url):
+    with urllib.request.urlopen(main_url + 'stats') as response:
+        return json.load(response)
+
+
+def run_stage(stage, main_url, work_dir, cli_options):
+    result_path = os.path.join(work_dir, f'{stage}.json')
+    served_before = _served_counts(main_url)
+    cli_args = ['--main-url', main_url] + cli_options + [stage]
+    start = time.perf_counter()
+    with open(os.path.join(work_dir, f'{stage}.log'), 'w') as log_file:
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--child', result_path, '--'] + cli_args,
+            cwd=work_dir,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+        )
+        # wait4 gives the rusage of this child alone.
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    wall_time = time.perf_counter() - start
+    served_after = _served_counts(main_url)
+    if process.returncode != 0 or not os.path.exists(result_path):
+        raise RuntimeError(f'{stage} failed, see {log_file.name}')
+    with open(result_path) as result_file:
+        result = json.load(result_file)
+    result['stage'] = stage
+    result['served'] = {
+        kind: count - served_before.get(kind, 0)
+        for kind, count in served_after.items()
+        if count != served_before.get(kind, 0)
+    }
+    result['process_time'] = wall_time
+    result['cpu_time'] = rusage.ru_utime + rusage.ru_stime
+    result['peak_rss'] = rusage.ru_maxrss * 1024
+    return result
+
+
+def _format_ms(seconds):
+    return '-' if seconds is None else f'{seconds * 1000:.1f}'
+
+
+def print_report(results):
+    print(
+        f'{"stage":<18} {"wall s":>8} {"served":>7} {"resp/s":>8} {"errors":>7} '
+        f'{"p50 ms":>8} {"p99 ms":>8} {"cpu s":>7} {"rss MiB":>8}'
+    )
+    for result in results:
+        wall_time = result['wall_time']
+        served = sum(result['served'].values())
+        responses_per_second = served / wall_time if wall_time else 0
+        print(
+            f'{result["stage"]:<18} {wall_time:>8.2f} {served:>7} {responses_per_second:>8.1f} '
+            f'{result["served"].get("error", 0):>7} '
+            f'{_format_ms(result["p50"]):>8} {_format_ms(result["p99"]):>8} '
+            f'{result["cpu_time"]:>7.2f} {result["peak_rss"] / 1024 / 1024:>8.1f}'
+        )
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[4:])
+        return
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--pages', type=int, default=20)
+    arg_parser.add_argument('--per-page', type=int, default=10)
+    arg_parser.add_argument('--file-size', type=int, default=256 * 1024, help='bytes per book file')
+    arg_parser.add_argument('--latency', type=float, default=0.0, help='milliseconds added to every response')
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of responses that are 503')
+    arg_parser.add_argument('--stages', nargs='+', choices=_STAGES, default=list(_STAGES))
+    arg_parser.add_argument('--json', help='also write the results to this file')
+    arg_parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    arg_parser.add_argument('cli_options', nargs=argparse.REMAINDER, help='-- followed by ebook-dl options')
+    args = arg_parser.parse_args()
+    cli_options = [option for option in args.cli_options if option != '--']
+    # The rate limit and the http cache would measure themselves, not the
+    # scraper, unless they are asked for after --.
+    cli_options = ['--rate-limit', '0', '--no-http-cache'] + cli_options
+
+    work_dir = tempfile.mkdtemp(prefix='ebook-dl-bench-')
+    mock_server, main_url = start_mock_server(args)
+    results = []
+    try:
+        for stage in args.stages:
+            results.append(run_stage(stage, main_url, work_dir, cli_options))
+    finally:
+        mock_server.terminate()
+        mock_server.wait()
+        if args.keep:
+            print(f'Scratch directory: {work_dir}')
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+from . import config
+from . import parser
+from . import retry
+from . import metrics
+from . import http_cache
+from .retry import RetryError, RetryPolicy
+from .rate_limiter import get_rate_limiter
+from .scraper import Scraper
+from .thread_manager import ThreadManager
+from .writer import DbWriter
+
+import time
+import asyncio
+import logging
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncScraper(Scraper):
+
+    _KEEPALIVE_TIMEOUT = 30
+    _DNS_CACHE_TTL = 300
+    _LOGGER = logging.getLogger(__name__)
+
+
+    def __init__(self):
+        if aiohttp is None:
+            raise RuntimeError('The async engine requires aiohttp, install it with `pip install aiohttp`.')
+        super().__init__()
+        self._concurrency = config.get('concurrency')
+
+
+    def _create_client_session(self):
+        # One pooled keep-alive connector is shared by every coroutine of a
+        # stage, so the number of open sockets never exceeds the concurrency
+        # nor the per host cap shared with the thread engine.
+        connector = aiohttp.TCPConnector(
+            limit=self._concurrency,
+            limit_per_host=min(self._concurrency, config.get('pool_maxsize')),
+            keepalive_timeout=AsyncScraper._KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=AsyncScraper._DNS_CACHE_TTL,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            headers=config.get('fake_headers'),
+            timeout=aiohttp.ClientTimeout(total=Scraper._REQUEST_TIMEOUT),
+        )
+
+
+    @staticmethod
+    async def _get_page(url, session):
+        # The cache, the db and the writer queue block, they are used from
+        # the default executor so that the event loop never waits on them.
+        cache = http_cache.get_cache()
+        page = await asyncio.to_thread(cache.lookup, url) if cache else None
+        if page is not None and cache.is_fresh(page):
+            return page.text
+        rate_limiter = get_rate_limiter()
+        await rate_limiter.acquire_async()
+        async with metrics.track_async('fetch_page'), \
+                session.get(url, headers=http_cache.HttpCache.conditional_headers(page)) as response:
+            rate_limiter.on_status(response.status)
+            if page is not None and response.status == 304:
+                await asyncio.to_thread(cache.revalidated, url)
+                return page.text
+            response.raise_for_status()
+            body = await response.read()
+            metrics.inc(metrics.BYTES_TOTAL, len(body), operation='fetch_page')
+            text = await response.text()
+        if cache:
+            await asyncio.to_thread(cache.store, url, text, response.headers)
+        return text
+
+
+    @staticmethod
+    async def _get_json(url, session):
+        rate_limiter = get_rate_limiter()
+        await rate_limiter.acquire_async()
+        async with session.get(url) as response:
+            rate_limiter.on_status(response.status)
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+
+    @staticmethod
+    def _call_with_retry(url, func, session):
+        return retry.get_policy().call_async(
+            url,
+            func,
+            session,
+            retry_on=(aiohttp.ClientError, ValueError) + RetryPolicy.DEFAULT_RETRY_ON
+        )
+
+
+    @staticmethod
+    async def _fetch_page(session, url):
+        return await AsyncScraper._call_with_retry(url, AsyncScraper._get_page, session)
+
+
+    @staticmethod
+    async def _retrieve_profile_page_urls(session, page_index, search_key):
+        index_page_url = Scraper._construct_search_api(search_key, page_index)
+        try:
+            page_text = await AsyncScraper._fetch_page(session, index_page_url)
+        except RetryError as e:
+            await asyncio.to_thread(Scraper._record_failure, Scraper._SEARCH_STAGE, index_page_url, e)
+            return None
+        return await parser.parse_async(Scraper._parse_listing_page, page_text)
+
+
+    @staticmethod
+    async def _run_collect_book_info(session, url):
+        try:
+            page_text = await AsyncScraper._fetch_page(session, Scraper._main_url() + url)
+        except RetryError as e:
+            await asyncio.to_thread(Scraper._record_failure, Scraper._PROFILE_STAGE, url, e)
+            return None
+        book_info = await parser.parse_async(Scraper._parse_profile_page, page_text)
+        return await asyncio.to_thread(Scraper._check_book_info, url, book_info)
+
+
+    @staticmethod
+    async def _get_resource_url_from_tn_url(session, tn_url):
+        resource_url = await asyncio.to_thread(Scraper._store().lookup_resolution, tn_url)
+        if resource_url:
+            return resource_url
+        url = Scraper._main_url() + '/download/' + tn_url
+        try:
+            async with metrics.track_async('resolve'):
+                res_json = await AsyncScraper._call_with_retry(url, AsyncScraper._get_json, session)
+        except RetryError as e:
+            await asyncio.to_thread(Scraper._record_failure, Scraper._RESOURCE_URL_STAGE, tn_url, e)
+            return ''
+        if res_json.get('ok'):
+            return res_json['url']
+        return ''
+
+
+    @staticmethod
+    async def _run_collect_book_url(session, book_url):
+        book_url.resource_url = await AsyncScraper._get_resource_url_from_tn_url(session, book_url.tn_url)
+        Scraper._set_download_target(book_url)
+        return book_url
+
+
+    async def _worker(self, job_queue, controller, on_result, job, session, job_args, succeeded):
+        while True:
+            item = await job_queue.get()
+            result = None
+            try:
+                await controller.acquire_async()
+                started_at = time.perf_counter()
+                try:
+                    result = await job(session, item, *job_args)
+                finally:
+                    controller.release(
+                        time.perf_counter() - started_at,
+                        result is not None and (succeeded is None or succeeded(result))
+                    )
+                if result is not None:
+                    await asyncio.to_thread(on_result, result)
+            except Exception as e:
+                AsyncScraper._LOGGER.error(f'Coroutine job failed: {e}')
+            finally:
+                job_queue.task_done()
+
+
+    async def _run_jobs(self, on_result, work_items, thread_job, job, *job_args, succeeded=None):
+        # --concurrency coroutines are started, the controller of the stage
+        # decides how many of them send requests at once.
+        controller = ThreadManager.controller(thread_job, self._concurrency)
+        job_queue = asyncio.Queue(maxsize=self._concurrency * 2)
+        async with self._create_client_session() as session:
+            workers = [
+                asyncio.create_task(
+                    self._worker(job_queue, controller, on_result, job, session, job_args, succeeded)
+                )
+                for _ in range(self._concurrency)
+            ]
+            for item in work_items:
+                await job_queue.put(item)
+            await job_queue.join()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+
+    def _retrieve_book_profile_page_urls_from_other_page(self, page_count, writer):
+        def on_result(urls):
+            self._book_profile_page_urls.extend(urls)
+            writer.put_profile_urls(urls)
+
+        asyncio.run(self._run_jobs(
+            on_result,
+            range(2, page_count + 1),
+            ThreadManager.THREAD_PROFILE_PAGE_JOB,
+            AsyncScraper._retrieve_profile_page_urls,
+            self._search_key
+        ))
+
+
+    def _collect_book_info_from_profile_pages(self):
+        with DbWriter() as writer:
+            asyncio.run(self._run_jobs(
+                writer.put_book_info,
+                self._book_profile_page_urls,
+                ThreadManager.THREAD_RETRIEVE_RESOURCE_JOB,
+                AsyncScraper._run_collect_book_info
+            ))
+
+
+    def _collect_resource_urls_from_tn_urls(self):
+        with DbWriter() as writer:
+            asyncio.run(self._run_jobs(
+                writer.put_book_url,
+                self._book_url_collection,
+                ThreadManager.THREAD_COLLECT_RESOURCE_URL_JOB,
+                AsyncScraper._run_collect_book_url,
+                succeeded=Scraper._resolved
+            ))
@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import math
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from . import config
+from . import metrics
+
+__all__ = ['ConcurrencyController', 'get_controller']
+
+
+class ConcurrencyController:
+
+    # Gradient: the latency of a window of jobs against the lowest latency
+    # seen lately. Within _LATENCY_TOLERANCE of it the limit grows by its
+    # square root (when the jobs used it all), beyond it the limit shrinks
+    # in proportion to the excess, by half at most. Throttling by the
+    # server or too many failed jobs halve it right away, like the
+    # RateLimiter does the rate.
+    _WINDOW_SECONDS = 1.0
+    _MIN_WINDOW_JOBS = 5
+    _LATENCY_TOLERANCE = 1.25
+    _MIN_GRADIENT = 0.5
+    _ERROR_RATE_THRESHOLD = 0.1
+    _DECREASE_FACTOR = 0.5
+    _SMOOTHING = 0.5
+    # The lowest latency creeps up a little every window, so that it follows
+    # the site when it gets slower over the day. Every _PROBE_EVERY windows
+    # one runs at half the limit, the queueing the limit itself causes
+    # would otherwise become part of the lowest latency as it creeps up.
+    _MIN_LATENCY_DRIFT = 1.01
+    _PROBE_EVERY = 30
+    _PROBE_FACTOR = 0.5
+    _INITIAL_FRACTION = 0.25
+    _LOGGER = logging.getLogger(__name__)
+
+
+    def __init__(self, name, ceiling, floor=None, adaptive=None):
+        self._name = name
+        floor = config.get('min_concurrency') if floor is None else floor
+        self._ceiling = max(ceiling, 1)
+        self._floor = min(max(floor, 1), self._ceiling)
+        self._adaptive = config.get('adaptive_concurrency') if adaptive is None else adaptive
+        self._limit = float(self._ceiling)
+        if self._adaptive:
+            self._limit = max(float(self._floor), self._ceiling * ConcurrencyController._INITIAL_FRACTION)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._waiters = deque()
+        self._min_latency = None
+        self._window_count = 0
+        self._probed_limit = None
+        self._reset_window(time.monotonic())
+        self._publish()
+
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+
+    @property
+    def ceiling(self):
+        return self._ceiling
+
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+
+    def _reset_window(self, now):
+        self._window_started_at = now
+        self._window_jobs = 0
+        self._window_errors = 0
+        self._window_latency = 0.0
+        self._window_peak = self._in_flight
+        self._window_throttled = metrics.get_registry().total(metrics.THROTTLED_TOTAL)
+
+
+    def _publish(self):
+        metrics.get_registry().gauge(metrics.CONCURRENCY_LIMIT, stage=self._name).set(self.limit)
+
+
+    def _start(self):
+        self._in_flight += 1
+        self._window_peak = max(self._window_peak, self._in_flight)
+
+
+    def acquire(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._start()
+
+
+    async def acquire_async(self):
+        with self._condition:
+            if self._in_flight < self.limit and not self._waiters:
+                self._start()
+                return
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._condition:
+                if future.done() and not future.cancelled():
+                    self._in_flight -= 1
+                elif future in self._waiters:
+                    self._waiters.remove(future)
+            raise
+
+
+    def release(self, latency, ok=True):
+        # Both acquire and acquire_async are released here, the coroutines
+        # waiting are resumed on the event loop they wait on, which is the
+        # one calling. A latency of None gives the slot back unmeasured, for
+        # a job that turned out to have nothing to do.
+        with self._condition:
+            self._in_flight -= 1
+            if latency is not None:
+                self._window_jobs += 1
+                self._window_latency += latency
+                if not ok:
+                    self._window_errors += 1
+                if self._adaptive:
+                    self._update(time.monotonic())
+            while self._waiters and self._in_flight < self.limit:
+                future = self._waiters.popleft()
+                if not future.done():
+                    self._start()
+                    future.set_result(None)
+            self._condition.notify(max(self.limit - self._in_flight, 0))
+
+
+    def _update(self, now):
+        if now - self._window_started_at < ConcurrencyController._WINDOW_SECONDS:
+            return
+        if self._window_jobs < ConcurrencyController._MIN_WINDOW_JOBS:
+            return
+        latency = self._window_latency / self._window_jobs
+        error_rate = self._window_errors / self._window_jobs
+        throttled = metrics.get_registry().total(metrics.THROTTLED_TOTAL) > self._window_throttled
+        if self._min_latency is None:
+            self._min_latency = latency
+        self._min_latency = min(self._min_latency * ConcurrencyController._MIN_LATENCY_DRIFT, latency)
+        self._window_count += 1
+        if throttled or error_rate > ConcurrencyController._ERROR_RATE_THRESHOLD:
+            limit = (self._probed_limit or self._limit) * ConcurrencyController._DECREASE_FACTOR
+            self._probed_limit = None
+        elif self._probed_limit is not None:
+            limit = self._probed_limit
+            self._probed_limit = None
+        elif self._window_count % ConcurrencyController._PROBE_EVERY == 0:
+            self._probed_limit = self._limit
+            limit = self._limit * ConcurrencyController._PROBE_FACTOR
+        else:
+            gradient = ConcurrencyController._LATENCY_TOLERANCE * self._min_latency / max(latency, 1e-9)
+            if gradient >= 1.0:
+                # Jobs that never used the whole limit tell nothing about a
+                # larger one.
+                limit = self._limit + (math.sqrt(self._limit) if self._window_peak >= self.limit else 0.0)
+            else:
+                limit = self._limit * max(ConcurrencyController._MIN_GRADIENT, gradient)
+            limit = self._limit + (limit - self._limit) * ConcurrencyController._SMOOTHING
+        previous_limit = self.limit
+        self._limit = min(float(self._ceiling), max(float(self._floor), limit))
+        if self.limit != previous_limit:
+            self._publish()
+            ConcurrencyController._LOGGER.debug(
+                f'{self._name} concurrency {previous_limit} -> {self.limit}, latency {latency * 1000:.0f}ms '
+                f'(lowest {self._min_latency * 1000:.0f}ms), errors {error_rate:.0%}, throttled {throttled}'
+            )
+        self._reset_window(now)
+
+
+_lock = threading.Lock()
+_controllers = {}
+
+
+def get_controller(name, ceiling):
+    # One controller per stage for the whole run, what a stage learned is
+    # kept when it is started again, like the batches of a worker.
+    if name not in _controllers:
+        with _lock:
+            if name not in _controllers:
+                _controllers[name] = ConcurrencyController(name, ceiling)
+    return _controllers[name]
@@ -20,6 +20,41 @@ def init():
     opts = {
         'console': Console(),
         'keyword': '',
+        'main_url': '',
+        'engine': 'thread',
+        'concurrency': 500,
+        'adaptive_concurrency': True,
+        'min_concurrency': 4,
+        'max_concurrency': 0,
+        'pool_hosts': 4,
+        'pool_maxsize': 64,
+        'max_attempts': 5,
+        'backoff_base': 1.0,
+        'backoff_max': 60.0,
+        'breaker_threshold': 20,
+        'breaker_reset': 30.0,
+        'rate_limit': 20.0,
+        'rate_burst': 10,
+        'write_batch_size': 200,
+        'write_interval': 5.0,
+        'html_parser': '',
+        'process_parse': False,
+        'download_connections': 4,
+        'max_download_connections': 32,
+        'download_rate_limit': 0.0,
+        'http_cache': True,
+        'cache_ttl': 3600.0,
+        'cache_max_size': 256,
+        'dedup': True,
+        'resolve_ttl': 7 * 24 * 3600.0,
+        'resolve_backoff': 3600.0,
+        'coordinator': '',
+        'lease_ttl': 60.0,
+        'dashboard': False,
+        'metrics_port': 0,
+        'metrics_json': '',
+        'profile': '',
+        'profile_allocations': False,
         'fake_headers': {
             'User-Agent': 'Mozilla/5.0 3578.98 Safari/537.36'
         }
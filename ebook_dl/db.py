@@ -1,44 +1,114 @@
 #!/usr/bin/python3
 # -*- conding:utf-8 -*-
 
+import time
+import zlib
+import atexit
 import sqlite3
 import logging
-
+import threading
+from contextlib import contextmanager
+from . import config
+from . import dedup
+from . import metrics
+
+# Hundreds of thousands of these can be alive during a crawl, __slots__
+# keeps them to a fixed size without a __dict__ each.
 class BookInfo:
-    def __init__(self):
-        self.id = ''
-        self.title = ''
-        self.details = ''
-        self.description = ''
-        self.tn_url = []
-        self.resource_url = []
+    __slots__ = ('id', 'title', 'details', 'description', 'tn_url', 'profile_url')
+
+    def __init__(self, id='', title='', details='', description='', tn_url='', profile_url=''):
+        self.id = id
+        self.title = title
+        self.details = details
+        self.description = description
+        self.tn_url = tn_url
+        self.profile_url = profile_url
+
+
+    def to_row(self):
+        return self.title, self.details, self.description
 
 
 class BookUrl:
-    def __init__(self, id='', book_id='', tn_url='', resource_url=''):
+    __slots__ = ('id', 'book_id', 'tn_url', 'resource_url', 'download_url', 'file_path', 'date_code')
+
+    def __init__(self, id='', book_id='', tn_url='', resource_url='', download_url='', file_path='', date_code=''):
         self.id = id
         self.book_id = book_id
         self.tn_url = tn_url
         self.resource_url = resource_url
+        self.download_url = download_url
+        self.file_path = file_path
+        self.date_code = date_code
+
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+
+    def to_row(self):
+        return (
+            self.id, self.book_id, self.tn_url, self.resource_url,
+            self.download_url, self.file_path, self.date_code,
+        )
 
 
 class Db:
 
     DB_FILE = 'ebook-dl.db'
+    READ_BATCH_SIZE = 1000
+    _BUSY_TIMEOUT = 30.0
     _LOGGER = logging.getLogger(__name__)
 
+    # WAL lets the readers go on while the writer thread commits, and with
+    # it synchronous=NORMAL only syncs at checkpoints. The cache is 64 MiB.
+    _PRAGMAS = (
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA synchronous = NORMAL',
+        'PRAGMA cache_size = -65536',
+        'PRAGMA temp_store = MEMORY',
+    )
+
+    # Every profile, book_info and book_url row tracks the state of the
+    # stage working on it: fetching the profile page, downloading the book
+    # and resolving its tn_url respectively.
+    STATUS_PENDING = 'pending'
+    STATUS_IN_FLIGHT = 'in-flight'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    # A profile url of a book another profile url is fetched for.
+    STATUS_DUPLICATE = 'duplicate'
+    UNFINISHED_STATUSES = (STATUS_PENDING, STATUS_IN_FLIGHT, STATUS_FAILED)
+
+    SEARCH_STAGE = 'search'
+    PROFILE_STAGE = 'profile'
+    RESOURCE_URL_STAGE = 'resource_url'
+    DOWNLOAD_STAGE = 'download'
+
     SQL_CREATE_BOOK_PROFILE_PAGE_URLS_TABLE = """
         CREATE TABLE IF NOT EXISTS profile (
             id INTEGER PRIMARY KEY,
-            url TEXT NOT NULL UNIQUE
+            url TEXT NOT NULL UNIQUE,
+            book_name TEXT NOT NULL DEFAULT (''),
+            status TEXT NOT NULL DEFAULT ('pending'),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            fetched_at TIMESTAMP
         );"""
 
     SQL_CREATE_BOOK_INFO_TABLE = """
         CREATE TABLE IF NOT EXISTS book_info (
             id INTEGER PRIMARY KEY,
             title TEXT NOT NULL UNIQUE,
+            title_key TEXT NOT NULL DEFAULT (''),
             details TEXT,
-            description TEXT
+            description TEXT,
+            status TEXT NOT NULL DEFAULT ('pending'),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            fetched_at TIMESTAMP
         );"""
     
     SQL_CREATE_BOOK_URL_TABLE = """
@@ -47,20 +117,207 @@ class Db:
             book_id INTEGER NOT NULL,
             tn_url TEXT NOT NULL UNIQUE,
             resource_url TEXT DEFAULT (''),
+            download_url TEXT NOT NULL DEFAULT (''),
+            file_path TEXT NOT NULL DEFAULT (''),
+            date_code TEXT NOT NULL DEFAULT (''),
+            status TEXT NOT NULL DEFAULT ('pending'),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            fetched_at TIMESTAMP,
             FOREIGN KEY (book_id) REFERENCES book_info (id)
         );"""
 
+    SQL_CREATE_INDEXES = (
+        'CREATE INDEX IF NOT EXISTS profile_status ON profile (status)',
+        'CREATE INDEX IF NOT EXISTS book_info_status ON book_info (status)',
+        'CREATE INDEX IF NOT EXISTS book_url_status ON book_url (status)',
+        'CREATE INDEX IF NOT EXISTS book_url_resource_url ON book_url (resource_url)',
+        'CREATE INDEX IF NOT EXISTS book_url_book_id ON book_url (book_id)',
+        'CREATE INDEX IF NOT EXISTS profile_book_name ON profile (book_name)',
+        'CREATE INDEX IF NOT EXISTS book_info_title_key ON book_info (title_key)',
+        'CREATE INDEX IF NOT EXISTS lease_worker ON lease (worker)',
+    )
+
+    # Columns added after a table was first released, they are added to the
+    # tables of older databases when those get opened, followed by the
+    # statement deriving their values from the older columns.
+    _STATE_COLUMNS = {
+        'status': "TEXT NOT NULL DEFAULT ('pending')",
+        'attempts': 'INTEGER NOT NULL DEFAULT 0',
+        'last_error': 'TEXT',
+        'fetched_at': 'TIMESTAMP',
+    }
+    MIGRATION_COLUMNS = {
+        'profile': dict(_STATE_COLUMNS, book_name="TEXT NOT NULL DEFAULT ('')"),
+        'book_info': dict(_STATE_COLUMNS, title_key="TEXT NOT NULL DEFAULT ('')"),
+        'book_url': dict(
+            _STATE_COLUMNS,
+            download_url="TEXT NOT NULL DEFAULT ('')",
+            file_path="TEXT NOT NULL DEFAULT ('')",
+            date_code="TEXT NOT NULL DEFAULT ('')",
+        ),
+    }
+    MIGRATION_BACKFILLS = {
+        'profile': 'UPDATE profile SET book_name = book_name(url)',
+        'book_info': 'UPDATE book_info SET title_key = title_key(title)',
+        'book_url': "UPDATE book_url SET status = 'done' WHERE resource_url <> ''",
+    }
+
+    SQL_MARK_FAILED = {
+        PROFILE_STAGE: 'UPDATE profile SET {} WHERE url = ?',
+        RESOURCE_URL_STAGE: 'UPDATE book_url SET {} WHERE tn_url = ?',
+        DOWNLOAD_STAGE: """
+            UPDATE book_info SET {} WHERE id IN (
+                SELECT book_id FROM book_url WHERE resource_url = ?
+            )""",
+    }
+    _SQL_SET_FAILED = 'status = ?, attempts = attempts + ?, last_error = ?'
+    _SQL_SET_DONE = 'status = ?, attempts = attempts + 1, last_error = NULL, fetched_at = CURRENT_TIMESTAMP'
+
+    SQL_CREATE_FAILURE_TABLE = """
+        CREATE TABLE IF NOT EXISTS failure (
+            id INTEGER PRIMARY KEY,
+            stage TEXT NOT NULL,
+            url TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (stage, url)
+        );"""
+
+    # tn_url -> resource_url results, also the failed ones ('') so that
+    # those are not asked for again before expires_at. Successes expire
+    # after resolve_ttl, failures after a backoff doubling per failure.
+    SQL_CREATE_RESOLUTION_TABLE = """
+        CREATE TABLE IF NOT EXISTS resolution (
+            tn_url TEXT PRIMARY KEY,
+            resource_url TEXT NOT NULL,
+            failures INTEGER NOT NULL DEFAULT 0,
+            resolved_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        );"""
+    _MAX_BACKOFF_DOUBLINGS = 16
 
-    def __init__(self):
+    # Downloaded files by content, a later file with the same size and hash
+    # is replaced by a hard link to path.
+    SQL_CREATE_CONTENT_TABLE = """
+        CREATE TABLE IF NOT EXISTS content (
+            id INTEGER PRIMARY KEY,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            path TEXT NOT NULL,
+            UNIQUE (size, sha256)
+        );"""
+
+    # The rows workers of a sharded crawl (see ledger.py) claimed, a lease
+    # the worker does not renew expires and the row can be claimed again.
+    SQL_CREATE_LEASE_TABLE = """
+        CREATE TABLE IF NOT EXISTS lease (
+            stage TEXT NOT NULL,
+            key TEXT NOT NULL,
+            worker TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (stage, key)
+        );"""
+    SQL_CREATE_WORKER_TABLE = """
+        CREATE TABLE IF NOT EXISTS worker (
+            id TEXT PRIMARY KEY,
+            seen_at REAL NOT NULL
+        );"""
+    # ?1 is the stage, ?2 the time, ?3 and ?4 the shard count and the shard
+    # to take the rows from, ?5 the batch size. Failed profile pages and
+    # downloads are left to the single process commands, failed tn_urls are
+    # retried once their backoff is over.
+    _SQL_NOT_LEASED = 'NOT EXISTS (SELECT 1 FROM lease WHERE stage = ?1 AND key = {} AND expires_at > ?2)'
+    SQL_SELECT_LEASABLE = {
+        PROFILE_STAGE: f"""
+            SELECT url FROM profile
+            WHERE status IN ('pending', 'in-flight') AND shard(url, ?3) = ?4
+            AND {_SQL_NOT_LEASED.format('profile.url')}
+            LIMIT ?5""",
+        RESOURCE_URL_STAGE: f"""
+            SELECT id, book_id, tn_url, resource_url, download_url, file_path, date_code FROM book_url
+            WHERE status IN ('pending', 'in-flight', 'failed') AND shard(tn_url, ?3) = ?4
+            AND {_SQL_NOT_LEASED.format('book_url.tn_url')}
+            AND tn_url NOT IN (SELECT tn_url FROM resolution WHERE resource_url = '' AND expires_at > ?2)
+            LIMIT ?5""",
+        DOWNLOAD_STAGE: f"""
+            SELECT book_url.id, book_url.book_id, book_url.tn_url, book_url.resource_url,
+                book_url.download_url, book_url.file_path, book_url.date_code
+            FROM book_url JOIN book_info ON book_info.id = book_url.book_id
+            WHERE book_info.status IN ('pending', 'in-flight') AND book_url.status = 'done'
+            AND shard(book_url.tn_url, ?3) = ?4 AND {_SQL_NOT_LEASED.format('book_url.tn_url')}
+            LIMIT ?5""",
+    }
+    # Index of the lease key in the selected rows, the profile url or the
+    # tn_url.
+    LEASE_KEY_INDEX = {PROFILE_STAGE: 0, RESOURCE_URL_STAGE: 2, DOWNLOAD_STAGE: 2}
+    # A leased row the worker brought back no result for, unless the worker
+    # recorded the failure itself.
+    SQL_FAIL_LEASED = {
+        PROFILE_STAGE: "UPDATE profile SET {} WHERE url = ? AND status IN ('pending', 'in-flight')",
+        RESOURCE_URL_STAGE: "UPDATE book_url SET {} WHERE tn_url = ? AND status IN ('pending', 'in-flight')",
+        DOWNLOAD_STAGE: """
+            UPDATE book_info SET {} WHERE status IN ('pending', 'in-flight')
+            AND id = (SELECT book_id FROM book_url WHERE tn_url = ?)""",
+    }
+
+    def __init__(self, dedup=True, resolve_ttl=7 * 24 * 3600, resolve_backoff=3600.0):
         self.conn = None
+        self.dedup = dedup
+        self.resolve_ttl = resolve_ttl
+        self.resolve_backoff = resolve_backoff
+        self._lock = threading.RLock()
+        self._transaction_depth = 0
 
 
     def create_connection(self):
+        # One connection lives as long as the Db, check_same_thread is off
+        # because every use of it goes through self._lock.
+        if self.conn is not None:
+            return
         try:
-            self.conn = sqlite3.connect(self.DB_FILE)
+            self.conn = sqlite3.connect(
+                self.DB_FILE,
+                timeout=self._BUSY_TIMEOUT,
+                check_same_thread=False,
+            )
+            self.conn.create_function('book_name', 1, dedup.book_name, deterministic=True)
+            self.conn.create_function('title_key', 1, dedup.title_key, deterministic=True)
+            self.conn.create_function('shard', 2, shard, deterministic=True)
+            for pragma_sql in self._PRAGMAS:
+                self.conn.execute(pragma_sql)
+            self.create_all_tables()
         except sqlite3.Error as e:
             Db._LOGGER.error(f'Db connection error: {e}')
-    
+
+
+    @contextmanager
+    def transaction(self, action='transaction', raise_errors=False):
+        # Nested transactions join the outermost one, which commits or rolls
+        # back everything done inside it. Its errors are logged, or raised
+        # for callers that handle them.
+        with self._lock:
+            self.create_connection()
+            self._transaction_depth += 1
+            try:
+                yield self.conn.cursor()
+                if self._transaction_depth == 1:
+                    self.conn.commit()
+            except sqlite3.Error as e:
+                if self._transaction_depth > 1:
+                    raise
+                self.conn.rollback()
+                if raise_errors:
+                    raise
+                Db._LOGGER.error(f'Db {action} error: {e}')
+            except Exception:
+                if self._transaction_depth == 1:
+                    self.conn.rollback()
+                raise
+            finally:
+                self._transaction_depth -= 1
+
 
     def create_table(self, create_table_sql):
         try:
@@ -70,130 +327,459 @@ class Db:
             Db._LOGGER.error(f'Db create table error: {e}')
 
 
-    def insert_profile_urls(self, urls):
-        sql = """ INSERT OR IGNORE INTO profile (url) VALUES (?) """
+    def migrate_table(self, table):
         try:
             cur = self.conn.cursor()
-            for url in urls:
-                cur.execute(sql, (url,))
+            cur.execute(f'PRAGMA table_info({table})')
+            existing_columns = {row[1] for row in cur.fetchall()}
+            missing_columns = [
+                (column, definition)
+                for column, definition in self.MIGRATION_COLUMNS.get(table, {}).items()
+                if column not in existing_columns
+            ]
+            if not missing_columns:
+                return
+            for column, definition in missing_columns:
+                cur.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            if table in self.MIGRATION_BACKFILLS:
+                cur.execute(self.MIGRATION_BACKFILLS[table])
             self.conn.commit()
         except sqlite3.Error as e:
-            Db._LOGGER.error(f'Db insertion profile error: {e}')
+            Db._LOGGER.error(f'Db migrate table error: {e}')
+
+
+    def create_all_tables(self):
+        self.create_table(self.SQL_CREATE_BOOK_PROFILE_PAGE_URLS_TABLE)
+        self.create_table(self.SQL_CREATE_BOOK_INFO_TABLE)
+        self.create_table(self.SQL_CREATE_BOOK_URL_TABLE)
+        self.create_table(self.SQL_CREATE_FAILURE_TABLE)
+        self.create_table(self.SQL_CREATE_CONTENT_TABLE)
+        self.create_table(self.SQL_CREATE_RESOLUTION_TABLE)
+        self.create_table(self.SQL_CREATE_LEASE_TABLE)
+        self.create_table(self.SQL_CREATE_WORKER_TABLE)
+        for table in self.MIGRATION_COLUMNS:
+            self.migrate_table(table)
+        for create_index_sql in self.SQL_CREATE_INDEXES:
+            self.create_table(create_index_sql)
+        self.conn.commit()
+
+
+    def insert_profile_urls(self, urls):
+        sql = """ INSERT OR IGNORE INTO profile (url, book_name) VALUES (?1, book_name(?1)) """
+        with self.transaction('insertion profile') as cur:
+            cur.executemany(sql, ((url,) for url in urls))
+
+
+    def mark_profile_urls_done(self, urls):
+        sql = f""" UPDATE profile SET {self._SQL_SET_DONE} WHERE url = ? """
+        with self.transaction('update profile status') as cur:
+            cur.executemany(sql, ((self.STATUS_DONE, url) for url in urls))
+
+
+    def mark_books_downloaded(self, tn_urls):
+        sql = f"""
+            UPDATE book_info SET {self._SQL_SET_DONE}
+            WHERE id = (SELECT book_id FROM book_url WHERE tn_url = ?)
+        """
+        with self.transaction('update book_info status') as cur:
+            cur.executemany(sql, ((self.STATUS_DONE, tn_url) for tn_url in tn_urls))
+
+
+    def mark_failed(self, stage, key, attempts, error):
+        if stage not in self.SQL_MARK_FAILED:
+            return
+        sql = self.SQL_MARK_FAILED[stage].format(self._SQL_SET_FAILED)
+        with self.transaction('update failed status') as cur:
+            cur.execute(sql, (self.STATUS_FAILED, attempts, error, key))
 
 
     def update_book_url_collection(self, book_url_collection):
+        # A tn_url the site has no file for is a failure of its own, the row
+        # must not look unprocessed like it used to with resource_url = ''.
         sql = """ 
             UPDATE book_url
-            SET resource_url = ?
-            WHERE id = ?
+            SET resource_url = ?1,
+                download_url = ?3,
+                file_path = ?4,
+                date_code = ?5,
+                status = CASE WHEN ?1 <> '' THEN 'done' ELSE 'failed' END,
+                attempts = attempts + 1,
+                last_error = CASE WHEN ?1 <> '' THEN NULL ELSE 'no resource url' END,
+                fetched_at = CURRENT_TIMESTAMP
+            WHERE tn_url = ?2
         """
-        try:
-            cur = self.conn.cursor()
-            for book_url in book_url_collection:
-                cur.execute(sql, (book_url.resource_url, book_url.id))
-            self.conn.commit()
-        except sqlite3.Error as e:
-            Db._LOGGER.error(f'Db update book url error: {e}')
+        with self.transaction('update book url') as cur:
+            cur.executemany(sql, (
+                (book_url.resource_url, book_url.tn_url, book_url.download_url, book_url.file_path, book_url.date_code)
+                for book_url in book_url_collection
+            ))
+            self.store_resolutions(book_url_collection)
+
+
+    def store_resolutions(self, book_url_collection):
+        sql = f"""
+            INSERT INTO resolution (tn_url, resource_url, failures, resolved_at, expires_at)
+            VALUES (?1, ?2, CASE WHEN ?2 <> '' THEN 0 ELSE 1 END, ?3,
+                    ?3 + CASE WHEN ?2 <> '' THEN ?4 ELSE min(?5, ?4) END)
+            ON CONFLICT (tn_url) DO UPDATE SET
+                resource_url = excluded.resource_url,
+                failures = CASE WHEN excluded.resource_url <> '' THEN 0 ELSE failures + 1 END,
+                resolved_at = excluded.resolved_at,
+                expires_at = excluded.resolved_at + CASE WHEN excluded.resource_url <> '' THEN ?4
+                    ELSE min(?5 * (1 << min(failures, {self._MAX_BACKOFF_DOUBLINGS})), ?4) END
+        """
+        now = time.time()
+        with self.transaction('store resolutions') as cur:
+            cur.executemany(sql, (
+                (book_url.tn_url, book_url.resource_url, now, self.resolve_ttl, self.resolve_backoff)
+                for book_url in book_url_collection
+            ))
+
+
+    def lookup_resolution(self, tn_url):
+        rows = self._select('lookup resolution', """
+            SELECT resource_url FROM resolution
+            WHERE tn_url = ? AND resource_url <> '' AND expires_at > ?
+        """, (tn_url, time.time()))
+        return rows[0][0] if rows else ''
 
 
     def insert_book_info_collection(self, info_collection):
+        # Titles differing only in case, spacing or punctuation are one book,
+        # the tn_urls of the later ones become book urls of the first.
         sql_insert_book_info = """
-            INSERT OR IGNORE INTO book_info (title,details,description) VALUES (?,?,?)
-        """
-        sql_select_book_info = """
-            SELECT id FROM book_info WHERE title=?
+            INSERT OR IGNORE INTO book_info (title,title_key,details,description)
+            SELECT ?1, title_key(?1), ?2, ?3
+            WHERE NOT EXISTS (SELECT 1 FROM book_info WHERE title_key = title_key(?1))
         """
+        # The book id is looked up by the title key index inside sqlite,
+        # instead of a SELECT round trip per book.
         sql_insert_book_url = """
-            INSERT OR IGNORE INTO book_url (book_id,tn_url) VALUES (?,?)
+            INSERT OR IGNORE INTO book_url (book_id,tn_url)
+            SELECT id, ? FROM book_info WHERE title_key = title_key(?) ORDER BY id LIMIT 1
         """
-        try:
-            cur = self.conn.cursor()
-            for book_info in info_collection:
-                cur.execute(
-                    sql_insert_book_info, 
-                    (
-                        book_info.title,
-                        book_info.details,
-                        book_info.description
-                    )
-                )
-            self.conn.commit()
-            for book_info in info_collection:
-                cur.execute(sql_select_book_info, (book_info.title,))
-                book_record = cur.fetchone()
-                if book_record and book_info.tn_url:
-                    book_id = book_record[0]
-                    cur.execute(
-                        sql_insert_book_url,
-                        (book_id, book_info.tn_url[0])
-                    )
-            self.conn.commit()
-        except sqlite3.Error as e:
-            Db._LOGGER.error(f'Db insertion book_info error: {e}')
+        with self.transaction('insertion book_info') as cur:
+            cur.executemany(sql_insert_book_info, (
+                book_info.to_row() for book_info in info_collection
+            ))
+            cur.executemany(sql_insert_book_url, (
+                (book_info.tn_url, book_info.title)
+                for book_info in info_collection if book_info.tn_url
+            ))
+
+
+    def insert_failure(self, stage, url, attempts, error):
+        sql = """
+            INSERT INTO failure (stage,url,attempts,last_error) VALUES (?,?,?,?)
+            ON CONFLICT (stage,url) DO UPDATE SET
+                attempts = attempts + excluded.attempts,
+                last_error = excluded.last_error,
+                failed_at = CURRENT_TIMESTAMP
+        """
+        with self.transaction('insertion failure') as cur:
+            cur.execute(sql, (stage, url, attempts, error))
 
 
-    def select_all_profile_urls(self):
-        self.create_connection()
+    def _select(self, action, sql, parameters=()):
         rows = []
-        try:
-            cur = self.conn.cursor()
-            cur.execute('SELECT url FROM profile')
-            rows = [row[0] for row in cur.fetchall()]
-        except sqlite3.Error as e:
-            Db._LOGGER.error(f'Db selection all profile urls error: {e}')
-        finally:
-            self.close_connection()
+        with self.transaction(action) as cur:
+            rows = cur.execute(sql, parameters).fetchall()
         return rows
 
 
+    def _iter_select(self, action, sql, parameters=(), batch_size=None):
+        # Keyset pagination, sql selects the id first and ends with
+        # `id > ? ORDER BY id LIMIT ?`. Only one batch is held at a time and
+        # the lock is released in between, so the writer thread may change
+        # the rows already handed out while the rest is being read.
+        batch_size = batch_size or self.READ_BATCH_SIZE
+        last_id = 0
+        while True:
+            rows = self._select(action, sql, parameters + (last_id, batch_size))
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+
+    def select_all_profile_urls(self, status=None):
+        if status is None:
+            sql = 'SELECT id, url FROM profile WHERE id > ? ORDER BY id LIMIT ?'
+            parameters = ()
+        else:
+            sql = 'SELECT id, url FROM profile WHERE status = ? AND id > ? ORDER BY id LIMIT ?'
+            parameters = (status,)
+        for row in self._iter_select('selection all profile urls', sql, parameters):
+            yield row[1]
+
+
+    def _statuses_placeholder(self, statuses):
+        return ','.join('?' * len(statuses))
+
+
+    def _claim(self, action, sql, statuses, parameters=()):
+        count = 0
+        with self.transaction(action) as cur:
+            count = cur.execute(sql, (self.STATUS_IN_FLIGHT,) + statuses + parameters).rowcount
+        return count
+
+
+    def mark_duplicate_profile_urls(self):
+        # Only one profile url of a book name is fetched: one that has been
+        # fetched already, else the first one still to fetch. Failed urls
+        # give way to the others, and once none of those is left the
+        # duplicates get their turn again.
+        live = (self.STATUS_PENDING, self.STATUS_IN_FLIGHT)
+        statuses = self.UNFINISHED_STATUSES
+        count = 0
+        with self.transaction('mark duplicate profile urls') as cur:
+            cur.execute(f"""
+                UPDATE profile SET status = ?
+                WHERE status = ? AND book_name <> ''
+                AND NOT EXISTS (
+                    SELECT 1 FROM profile AS other
+                    WHERE other.book_name = profile.book_name AND other.id <> profile.id
+                    AND other.status IN (?, {self._statuses_placeholder(live)})
+                )
+            """, (self.STATUS_PENDING, self.STATUS_DUPLICATE, self.STATUS_DONE) + live)
+            count = cur.execute(f"""
+                UPDATE profile SET status = ?
+                WHERE status IN ({self._statuses_placeholder(statuses)}) AND book_name <> ''
+                AND EXISTS (
+                    SELECT 1 FROM profile AS other
+                    WHERE other.book_name = profile.book_name AND other.id <> profile.id
+                    AND (other.status = ? OR other.status IN ({self._statuses_placeholder(live)})
+                        AND (other.id < profile.id OR profile.status = ?)
+                        OR other.status = ? AND profile.status = ? AND other.id < profile.id)
+                )
+            """, (self.STATUS_DUPLICATE,) + statuses + (self.STATUS_DONE,) + live + (self.STATUS_FAILED,) * 3).rowcount
+        return count
+
+
+    def claim_profile_urls(self, failed_only=False):
+        # Rows left in-flight by an interrupted run are claimed again.
+        statuses = (self.STATUS_FAILED,) if failed_only else self.UNFINISHED_STATUSES
+        count = 0
+        with self.transaction('claim profile urls'):
+            if self.dedup:
+                metrics.inc(metrics.DUPLICATES_TOTAL, self.mark_duplicate_profile_urls(), kind='profile')
+            count = self._claim('claim profile urls', f"""
+                UPDATE profile SET status = ?
+                WHERE status IN ({self._statuses_placeholder(statuses)})
+            """, statuses)
+        return count
+
+
+    def claim_book_urls(self, use_resource_url=False):
+        statuses = self._statuses_placeholder(self.UNFINISHED_STATUSES)
+        if use_resource_url:
+            # Resolved books that are not downloaded yet.
+            return self._claim('claim books to download', f"""
+                UPDATE book_info SET status = ?
+                WHERE status IN ({statuses})
+                AND id IN (SELECT book_id FROM book_url WHERE status = 'done')
+            """, self.UNFINISHED_STATUSES)
+        # tn_urls that failed and are still backing off are left alone.
+        return self._claim('claim book urls', f"""
+            UPDATE book_url SET status = ? WHERE status IN ({statuses})
+            AND tn_url NOT IN (
+                SELECT tn_url FROM resolution WHERE resource_url = '' AND expires_at > ?
+            )
+        """, self.UNFINISHED_STATUSES, (time.time(),))
+
+
+    def count_backing_off_book_urls(self):
+        rows = self._select('count backing off book urls', """
+            SELECT COUNT(*) FROM book_url JOIN resolution USING (tn_url)
+            WHERE book_url.status = ? AND resolution.resource_url = '' AND resolution.expires_at > ?
+        """, (self.STATUS_FAILED, time.time()))
+        return rows[0][0] if rows else 0
+
+
     def select_all_book_urls(self, use_resource_url=False):
+        # The rows claimed by claim_book_urls.
         if use_resource_url:
-            sql = 'SELECT * FROM book_url WHERE resource_url <> ""'
+            sql = """
+                SELECT book_url.id, book_url.book_id, book_url.tn_url, book_url.resource_url,
+                    book_url.download_url, book_url.file_path, book_url.date_code
+                FROM book_url JOIN book_info ON book_info.id = book_url.book_id
+                WHERE book_info.status = ? AND book_url.status = 'done'
+                AND book_url.id > ? ORDER BY book_url.id LIMIT ?
+            """
+        else:
+            sql = """
+                SELECT id, book_id, tn_url, resource_url, download_url, file_path, date_code FROM book_url
+                WHERE status = ? AND id > ? ORDER BY id LIMIT ?
+            """
+        for row in self._iter_select('selection all book urls', sql, (self.STATUS_IN_FLIGHT,)):
+            yield BookUrl.from_row(row)
+
+
+    def count_profile_urls(self, status=None):
+        if status is None:
+            rows = self._select('count profile urls', 'SELECT COUNT(*) FROM profile')
         else:
-            sql = 'SELECT * FROM book_url WHERE resource_url = ""'
-        self.create_connection()
+            rows = self._select('count profile urls', 'SELECT COUNT(*) FROM profile WHERE status = ?', (status,))
+        return rows[0][0] if rows else 0
+
+
+    def count_profile_book_names(self, status):
+        rows = self._select('count profile book names', """
+            SELECT COUNT(DISTINCT book_name) FROM profile WHERE status = ? AND book_name <> ''
+        """, (status,))
+        return rows[0][0] if rows else 0
+
+
+    def _see_worker(self, cur, worker, now):
+        cur.execute(
+            'INSERT INTO worker (id, seen_at) VALUES (?1, ?2) ON CONFLICT (id) DO UPDATE SET seen_at = ?2',
+            (worker, now)
+        )
+
+
+    def lease_rows(self, stage, worker, count, lease_ttl):
+        # The rows are hash partitioned by their key over the live workers,
+        # a worker takes the rows of its own shard first and then those of
+        # any shard, so that the ones of a worker gone or slower are not
+        # left behind. IMMEDIATE keeps other processes sharing the db file
+        # from leasing the same rows meanwhile.
+        sql = self.SQL_SELECT_LEASABLE[stage]
+        key_index = self.LEASE_KEY_INDEX[stage]
+        now = time.time()
         rows = []
-        try:
-            cur = self.conn.cursor()
-            cur.execute(sql)
-            rows = [BookUrl(row[0], row[1], row[2], row[3]) for row in cur.fetchall()]
-        except sqlite3.Error as e:
-            Db._LOGGER.error(f'Db selection all book urls error: {e}')
-        finally:
-            self.close_connection()
+        with self.transaction('lease rows') as cur:
+            if not self.conn.in_transaction:
+                cur.execute('BEGIN IMMEDIATE')
+            self._see_worker(cur, worker, now)
+            workers = [row[0] for row in cur.execute(
+                'SELECT id FROM worker WHERE seen_at > ? ORDER BY id', (now - lease_ttl,)
+            )]
+            for shard_count, own_shard in ((len(workers), workers.index(worker)), (1, 0)):
+                if len(rows) == count:
+                    break
+                shard_rows = cur.execute(sql, (stage, now, shard_count, own_shard, count - len(rows))).fetchall()
+                cur.executemany(
+                    'INSERT OR REPLACE INTO lease (stage, key, worker, expires_at) VALUES (?, ?, ?, ?)',
+                    ((stage, row[key_index], worker, now + lease_ttl) for row in shard_rows)
+                )
+                rows += shard_rows
         return rows
 
 
+    def renew_leases(self, worker, lease_ttl):
+        now = time.time()
+        with self.transaction('renew leases') as cur:
+            self._see_worker(cur, worker, now)
+            cur.execute('UPDATE lease SET expires_at = ? WHERE worker = ?', (now + lease_ttl, worker))
+
+
+    def finish_leases(self, stage, worker, keys, error):
+        keys = list(keys)
+        with self.transaction('finish leases') as cur:
+            cur.executemany(
+                self.SQL_FAIL_LEASED[stage].format(self._SQL_SET_FAILED),
+                ((self.STATUS_FAILED, 1, error, key) for key in keys)
+            )
+            cur.executemany(
+                'DELETE FROM lease WHERE stage = ? AND key = ? AND worker = ?',
+                ((stage, key, worker) for key in keys)
+            )
+
+
+    def remove_worker(self, worker):
+        with self.transaction('remove worker') as cur:
+            cur.execute('DELETE FROM lease WHERE worker = ?', (worker,))
+            cur.execute('DELETE FROM worker WHERE id = ?', (worker,))
+
+
+    def count_leases(self):
+        rows = self._select(
+            'count leases', 'SELECT stage, COUNT(*) FROM lease WHERE expires_at > ? GROUP BY stage', (time.time(),)
+        )
+        return dict(rows)
+
+
+    def count_workers(self, lease_ttl):
+        rows = self._select('count workers', 'SELECT COUNT(*) FROM worker WHERE seen_at > ?', (time.time() - lease_ttl,))
+        return rows[0][0] if rows else 0
+
+
+    def store_content(self, size, sha256, path):
+        # Returns the path the content was first stored at, path itself when
+        # it is new. A first copy that is gone is replaced by path.
+        with self.transaction('store content') as cur:
+            cur.execute(
+                'INSERT OR IGNORE INTO content (size,sha256,path) VALUES (?,?,?)',
+                (size, sha256, path)
+            )
+            row = cur.execute(
+                'SELECT path FROM content WHERE size = ? AND sha256 = ?', (size, sha256)
+            ).fetchone()
+        return row[0] if row else path
+
+
+    def replace_content_path(self, size, sha256, path):
+        with self.transaction('replace content path') as cur:
+            cur.execute('UPDATE content SET path = ? WHERE size = ? AND sha256 = ?', (path, size, sha256))
+
+
     def store_profile_page_urls(self, profile_page_urls):
-        if not profile_page_urls:
-            return
-        self.create_connection()
-        self.create_table(self.SQL_CREATE_BOOK_PROFILE_PAGE_URLS_TABLE)
-        self.insert_profile_urls(profile_page_urls)
-        self.close_connection()
+        if profile_page_urls:
+            self.insert_profile_urls(profile_page_urls)
 
 
     def store_book_info_collection(self, book_info_collection):
-        if not book_info_collection:
-            return
-        self.create_connection()
-        self.create_table(self.SQL_CREATE_BOOK_INFO_TABLE)
-        self.create_table(self.SQL_CREATE_BOOK_URL_TABLE)
-        self.insert_book_info_collection(book_info_collection)
-        self.close_connection()
+        if book_info_collection:
+            self.insert_book_info_collection(book_info_collection)
 
 
     def store_book_url_collection(self, book_url_collection):
-        if not book_url_collection:
-            return
-        self.create_connection()
-        self.update_book_url_collection(book_url_collection)
-        self.close_connection()
+        if book_url_collection:
+            self.update_book_url_collection(book_url_collection)
+
+
+    def store_failure(self, stage, url, attempts, error):
+        with self.transaction('store failure'):
+            self.insert_failure(stage, url, attempts, error)
+            self.mark_failed(stage, url, attempts, error)
 
 
     def close_connection(self):
-        if self.conn:
-            self.conn.close()
+        with self._lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+
+def shard(key, count):
+    # crc32 rather than hash(), which differs from one process to another.
+    return zlib.crc32(key.encode('utf-8')) % count
+
+
+_lock = threading.Lock()
+_db = None
+
+
+def get_db():
+    global _db
+    if _db is None:
+        with _lock:
+            if _db is None:
+                _db = Db(
+                    dedup=config.get('dedup'),
+                    resolve_ttl=config.get('resolve_ttl'),
+                    resolve_backoff=config.get('resolve_backoff'),
+                )
+                atexit.register(close)
+    return _db
+
+
+def close():
+    global _db
+    with _lock:
+        if _db is not None:
+            _db.close_connection()
+            _db = None
 
 
 if __name__ == '__main__':
@@ -207,10 +793,10 @@ if __name__ == '__main__':
     bookInfo1.title = 'book title 1'
     bookInfo1.details = 'book details 1'
     bookInfo1.description = 'book description 1'
-    bookInfo1.tn_url = ['tn_url 1']
+    bookInfo1.tn_url = 'tn_url 1'
     bookInfo2.title = 'book title 2'
     bookInfo2.details = 'book details 2'
     bookInfo2.description = 'book description 2'
-    bookInfo2.tn_url = ['tn_url 2']
+    bookInfo2.tn_url = 'tn_url 2'
     db.store_book_info_collection([bookInfo1, bookInfo2])
     #db.close_connection()
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import os
+import re
+import hashlib
+import logging
+from urllib.parse import unquote
+from . import metrics
+
+__all__ = ['book_name', 'title_key', 'new_digest', 'finish_digest', 'link_duplicate']
+
+_PROFILE_URL_PATTERN = re.compile(r'/book/([^/]+)/\d+/?$')
+_NON_WORD_PATTERN = re.compile(r'[\W_]+')
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _normalise(text):
+    return _NON_WORD_PATTERN.sub(' ', text.casefold()).strip()
+
+
+# Both are registered as sqlite functions by the Db, keep them deterministic.
+def book_name(profile_url):
+    match = _PROFILE_URL_PATTERN.search(profile_url or '')
+    return _normalise(unquote(match.group(1))) if match else ''
+
+
+def title_key(title):
+    return _normalise(title or '') or title
+
+
+def finish_digest(digest, path, offset):
+    # The digest holds the first offset bytes already, hashed while they
+    # were streamed, the rest is read back from the file.
+    with open(path, 'rb') as content_file:
+        content_file.seek(offset)
+        for chunk in iter(lambda: content_file.read(_HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def new_digest():
+    return hashlib.sha256()
+
+
+def _has_content(path, size, sha256):
+    try:
+        if os.path.getsize(path) != size:
+            return False
+        return finish_digest(new_digest(), path, 0) == sha256
+    except OSError:
+        return False
+
+
+def link_duplicate(path, original_path, size, sha256):
+    # path is replaced by a hard link to the file with the same content, a
+    # file system without hard links just keeps both copies. An original
+    # that is gone or was changed since is not linked to, path becomes the
+    # copy of record instead.
+    if not os.path.exists(original_path):
+        return False
+    if os.path.samefile(path, original_path):
+        return True
+    if not _has_content(original_path, size, sha256):
+        _LOGGER.info(f'{original_path} no longer has the content of {path}, keeping {path}')
+        return False
+    temp_path = path + '.link'
+    try:
+        os.link(original_path, temp_path)
+        os.replace(temp_path, path)
+    except OSError as e:
+        _LOGGER.warning(f'Could not link {path} to {original_path}: {e}')
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return True
+    metrics.inc(metrics.DUPLICATES_TOTAL, kind='content')
+    _LOGGER.info(f'{path} has the same content as {original_path}, linked')
+    return True
@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import os
+import re
+from collections import namedtuple
+from urllib.parse import quote
+
+__all__ = ['DownloadTarget', 'parse']
+
+DownloadTarget = namedtuple('DownloadTarget', ['url', 'file_path', 'date_code'])
+
+# Characters that would take a file name out of the output directory or that
+# no file system takes, the rest of the name is kept as the site has it.
+_UNSAFE_PATTERN = re.compile(r'[\x00-\x1f\x7f/\\]')
+_UNSAFE_NAMES = frozenset(('', '.', '..'))
+
+
+def _safe_name(name):
+    name = _UNSAFE_PATTERN.sub('_', name)
+    return None if name in _UNSAFE_NAMES else name
+
+
+def parse(resource_url, main_url, output_dir):
+    # A resource url is a path on the site like /<...>/<date code>/<file
+    # name>, some have an empty segment before the file name. The file is
+    # saved as "<date code> <file name>" in output_dir. Anything else, like
+    # the absolute urls of dead mirrors, has no target.
+    if not resource_url.startswith('/'):
+        return None
+    directory, _, filename = resource_url.rpartition('/')
+    safe_filename = _safe_name(filename)
+    if safe_filename is None:
+        return None
+    date_code = next(filter(None, reversed(directory.split('/'))), '')
+    safe_date_code = _safe_name(date_code) or ''
+    url_prefix = f'{main_url}{directory[1:]}/' if directory else main_url
+    file_name = f'{safe_date_code} {safe_filename}' if safe_date_code else safe_filename
+    return DownloadTarget(
+        url_prefix + quote(filename),
+        os.path.join(output_dir, file_name),
+        safe_date_code,
+    )
@@ -0,0 +1,485 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import os
+import re
+import json
+import time
+import heapq
+import queue
+import logging
+import itertools
+import threading
+from . import config
+from . import dedup
+from . import retry
+from . import metrics
+from . import session
+from .retry import RetryError, RetryableError
+from .rate_limiter import RateLimiter
+from .concurrency import get_controller
+from .thread_manager import ThreadManager
+
+__all__ = ['Download', 'Downloader', 'DownloadScheduler', 'RichDownloadProgress']
+
+
+class RichDownloadProgress:
+
+    def __init__(self, progress):
+        self._progress = progress
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+
+    def start(self, name, total, completed):
+        with self._lock:
+            self._tasks[name] = self._progress.add_task(name, total=total, completed=completed)
+
+
+    def advance(self, name, size):
+        # Progress is only shown, a download never fails over it.
+        task = self._tasks.get(name)
+        if task is not None:
+            self._progress.advance(task, size)
+
+
+    def finish(self, name):
+        with self._lock:
+            task = self._tasks.pop(name, None)
+        if task is not None:
+            self._progress.remove_task(task)
+
+
+class Download:
+
+    # segments are [start, end, done] lists, end is None when the server
+    # sent no size and the file has to come in one piece.
+    def __init__(self, url, path, item, size, accepts_ranges, segments, complete=False):
+        self.url = url
+        self.path = path
+        self.item = item
+        self.name = os.path.basename(path)
+        self.part_path = path + Downloader.PART_SUFFIX
+        self.state_path = path + Downloader.STATE_SUFFIX
+        self.size = size
+        self.accepts_ranges = accepts_ranges
+        self.segments = segments
+        self.complete = complete
+        self.next_segment = 0
+        self.running = 0
+        self.error = None
+        self.unsaved = 0
+        # digest holds the sha256 of the first hashed bytes of the file, it
+        # only grows by the chunks that continue them.
+        self.digest = None
+        self.hashed = 0
+        self.sha256 = None
+        self.lock = threading.Lock()
+
+
+    @property
+    def priority(self):
+        # Largest first, so the long downloads are not the ones left at the
+        # end with a single connection each.
+        return -(self.size or 0)
+
+
+class Downloader:
+
+    PART_SUFFIX = '.part'
+    STATE_SUFFIX = '.part.json'
+
+    _CHUNK_SIZE = 64 * 1024
+    _MIN_SEGMENT_SIZE = 1024 * 1024
+    _STATE_SAVE_BYTES = 1024 * 1024
+    _REQUEST_TIMEOUT = 30
+    _CONTENT_RANGE_PATTERN = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+    _LOGGER = logging.getLogger(__name__)
+
+
+    def __init__(self, connections=None, progress=None, hash_content=None):
+        self._connections = connections or config.get('download_connections')
+        self._progress = progress
+        self._hash_content = config.get('dedup') if hash_content is None else hash_content
+
+
+    def _get(self, url, first_byte=None, last_byte=None):
+        # Byte offsets only line up with the file on disk without a content
+        # encoding on top.
+        headers = {'Accept-Encoding': 'identity'}
+        if first_byte is not None:
+            headers['Range'] = f'bytes={first_byte}-{"" if last_byte is None else last_byte}'
+        response = session.get(
+            url,
+            headers=headers,
+            stream=True,
+            timeout=Downloader._REQUEST_TIMEOUT,
+        )
+        response.raise_for_status()
+        return response
+
+
+    def probe(self, url):
+        # A one byte range request tells the size and the range support in
+        # one go, some servers answer HEAD requests differently than GET.
+        response = self._get(url, 0, 0)
+        response.close()
+        if response.status_code == 206:
+            match = Downloader._CONTENT_RANGE_PATTERN.match(response.headers.get('Content-Range', ''))
+            if match and match.group(3) != '*':
+                return int(match.group(3)), True
+        content_length = response.headers.get('Content-Length')
+        return (int(content_length) if content_length else None), False
+
+
+    def report(self, method, *args):
+        if self._progress is None:
+            return
+        try:
+            getattr(self._progress, method)(*args)
+        except Exception as e:
+            Downloader._LOGGER.debug(f'Progress {method} for {args[0]} failed: {e}')
+
+
+    @staticmethod
+    def _split(size, connections):
+        segment_size = max(-(-size // connections), Downloader._MIN_SEGMENT_SIZE)
+        return [
+            [start, min(start + segment_size, size) - 1, 0]
+            for start in range(0, size, segment_size)
+        ]
+
+
+    @staticmethod
+    def _load_segments(state_path, part_path, size):
+        try:
+            with open(state_path) as state_file:
+                state = json.load(state_file)
+            if state['size'] == size and os.path.getsize(part_path) == size:
+                return state['segments']
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+
+    @staticmethod
+    def save_segments(download):
+        if not download.accepts_ranges:
+            return
+        temp_path = download.state_path + '.tmp'
+        with download.lock:
+            with open(temp_path, 'w') as state_file:
+                json.dump({'size': download.size, 'segments': download.segments}, state_file)
+            os.replace(temp_path, download.state_path)
+            download.unsaved = 0
+
+
+    def prepare(self, url, path, item=None):
+        size, accepts_ranges = self.probe(url)
+        if size is not None and os.path.exists(path) and os.path.getsize(path) == size:
+            return Download(url, path, item, size, accepts_ranges, [], complete=True)
+        if not accepts_ranges:
+            download = Download(url, path, item, size, False, [[0, None if size is None else size - 1, 0]])
+        else:
+            download = Download(url, path, item, size, True, None)
+            download.segments = Downloader._load_segments(download.state_path, download.part_path, size)
+            if download.segments is None:
+                download.segments = Downloader._split(size, self._connections)
+                with open(download.part_path, 'wb') as part_file:
+                    part_file.truncate(size)
+        if self._hash_content:
+            download.digest = dedup.new_digest()
+        return download
+
+
+    def _on_written(self, download, segment, chunk):
+        # The state lags behind the data on disk, never ahead of it, so a
+        # resumed segment at worst fetches the last megabyte again.
+        length = len(chunk)
+        with download.lock:
+            if download.digest is not None and segment[0] + segment[2] == download.hashed:
+                download.digest.update(chunk)
+                download.hashed += length
+            segment[2] += length
+            download.unsaved += length
+            save = download.unsaved >= Downloader._STATE_SAVE_BYTES
+        if save:
+            Downloader.save_segments(download)
+        metrics.inc(metrics.BYTES_TOTAL, length, operation='download')
+        self.report('advance', download.name, length)
+
+
+    def fetch_segment(self, download, segment, bandwidth=None):
+        start, end, done = segment
+        if end is not None and start + done > end:
+            return
+        if download.accepts_ranges:
+            response = self._get(download.url, start + done, end)
+        else:
+            # Without range support a retry starts over from the first byte.
+            response = self._get(download.url)
+            segment[2] = done = 0
+            if download.digest is not None:
+                download.digest = dedup.new_digest()
+                download.hashed = 0
+        with response:
+            if download.accepts_ranges and response.status_code != 206:
+                raise RetryableError(f'Range request for {download.name} was not honoured')
+            with open(download.part_path, 'r+b' if download.accepts_ranges else 'wb') as part_file:
+                part_file.seek(start + done)
+                for chunk in response.iter_content(Downloader._CHUNK_SIZE):
+                    if bandwidth is not None:
+                        bandwidth.acquire(len(chunk))
+                    part_file.write(chunk)
+                    self._on_written(download, segment, chunk)
+        if end is not None and segment[0] + segment[2] <= end:
+            raise RetryableError(f'Connection for {download.name} closed at byte {segment[0] + segment[2]}')
+
+
+    def finish(self, download):
+        missing = sum(
+            end - start + 1 - done
+            for start, end, done in download.segments
+            if end is not None
+        )
+        if missing:
+            raise RetryableError(f'{missing} bytes missing from {download.name}')
+        if download.digest is not None:
+            # Segments after the first arrive out of order, whatever was not
+            # hashed on the way in is read back while it is still cached.
+            download.sha256 = dedup.finish_digest(download.digest, download.part_path, download.hashed)
+            if download.size is None:
+                download.size = os.path.getsize(download.part_path)
+        if download.accepts_ranges and os.path.exists(download.state_path):
+            os.remove(download.state_path)
+        os.replace(download.part_path, download.path)
+
+
+class DownloadScheduler:
+
+    # The latency of a transfer is its time per MiB, segments differ in size.
+    _LATENCY_BYTES = 1024 * 1024
+    _STOP = object()
+    _DELIVERED = object()
+    _FAILED = object()
+    _LOGGER = logging.getLogger(__name__)
+
+
+    def __init__(self, downloader=None, connections=None, rate_limit=None, on_failure=None, on_complete=None):
+        self._downloader = downloader or Downloader()
+        self._connections = connections or config.get('max_download_connections')
+        if rate_limit is None:
+            rate_limit = config.get('download_rate_limit')
+        # Bytes are the tokens here, a chunk is only written once the cap
+        # allows it, and TCP flow control slows the sender down meanwhile.
+        self._bandwidth = RateLimiter(rate_limit * 1024, Downloader._CHUNK_SIZE, adaptive=False)
+        # As many workers as connections are started, the controller lets as
+        # many of them transfer at once as the bandwidth is shared well by.
+        self._controller = get_controller('download', self._connections)
+        self._on_failure = on_failure
+        self._on_complete = on_complete
+        # url -> the items waiting for the download of the same url, or
+        # whether it was delivered or failed already.
+        self._duplicates = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._feeding = True
+        self._results = queue.Queue(maxsize=self._connections * 2)
+
+
+    def _prepare(self, job):
+        url, path, item = job
+        try:
+            return retry.get_policy().call(url, self._downloader.prepare, path, item)
+        except RetryError as e:
+            self._fail(url, item, e)
+        return None
+
+
+    def _fail(self, url, item, error):
+        with self._condition:
+            self._duplicates[url] = DownloadScheduler._FAILED
+        if self._on_failure is not None:
+            self._on_failure(item, error)
+
+
+    def _deliver(self, download):
+        with self._condition:
+            followers = self._duplicates.get(download.url)
+            self._duplicates[download.url] = DownloadScheduler._DELIVERED
+        self._results.put(download.item)
+        if isinstance(followers, list):
+            for item in followers:
+                self._results.put(item)
+
+
+    def _unique_jobs(self, jobs):
+        # Books sharing a resource url are downloaded once, the others share
+        # the outcome of the first. A failure is recorded for the url, which
+        # covers all of them.
+        for job in jobs:
+            url, _, item = job
+            with self._condition:
+                state = self._duplicates.get(url)
+                if state is None:
+                    self._duplicates[url] = []
+                elif isinstance(state, list):
+                    state.append(item)
+            if state is None:
+                yield job
+                continue
+            metrics.inc(metrics.DUPLICATES_TOTAL, kind='url')
+            if state is DownloadScheduler._DELIVERED:
+                self._results.put(item)
+
+
+    def _feed(self, jobs):
+        thread_manager = ThreadManager()
+        thread_manager.thread_job_distribution(self._unique_jobs(jobs), ThreadManager.THREAD_DOWNLOAD_JOB)
+        thread_manager.thread_job_preparation(self._prepare, ThreadManager.THREAD_DOWNLOAD_JOB)
+        try:
+            for download in thread_manager.thread_job_results():
+                if download.complete:
+                    self._deliver(download)
+                    continue
+                if not download.segments:
+                    # An empty file, or a state file listing no segments,
+                    # leaves nothing for the workers to fetch.
+                    self._settle(download)
+                    continue
+                with self._condition:
+                    # The task is there before any segment is handed out,
+                    # whichever worker writes the first bytes.
+                    self._downloader.report(
+                        'start', download.name, download.size,
+                        sum(done for _, _, done in download.segments)
+                    )
+                    heapq.heappush(self._heap, (download.priority, next(self._sequence), download))
+                    self._condition.notify()
+        except Exception as e:
+            DownloadScheduler._LOGGER.error(f'Probing downloads failed: {e}')
+        finally:
+            with self._condition:
+                self._feeding = False
+                self._condition.notify_all()
+
+
+    def _next_segment(self):
+        with self._condition:
+            while True:
+                while self._heap:
+                    download = self._heap[0][2]
+                    if download.error is not None:
+                        heapq.heappop(self._heap)
+                        continue
+                    segment = download.segments[download.next_segment]
+                    download.next_segment += 1
+                    download.running += 1
+                    if download.next_segment == len(download.segments):
+                        heapq.heappop(self._heap)
+                    return download, segment
+                if not self._feeding:
+                    return None
+                self._condition.wait()
+
+
+    def _worker(self):
+        # results() waits for a _STOP from every worker, whatever ends it.
+        try:
+            while True:
+                work = self._next_segment()
+                if work is None:
+                    break
+                download, segment = work
+                try:
+                    error = self._transfer(download, segment)
+                except Exception as e:
+                    error = e
+                with self._condition:
+                    download.running -= 1
+                    if error is not None and download.error is None:
+                        download.error = error
+                    last = download.running == 0 and (
+                        download.error is not None or download.next_segment == len(download.segments)
+                    )
+                if last:
+                    self._settle(download)
+        finally:
+            self._results.put(DownloadScheduler._STOP)
+
+
+    def _transfer(self, download, segment):
+        error = None
+        self._controller.acquire()
+        started_at = time.perf_counter()
+        fetched = segment[2]
+        try:
+            retry.get_policy().call(download.url, self._fetch, download, segment)
+        except Exception as e:
+            error = e
+        finally:
+            fetched = segment[2] - fetched
+            latency = None
+            if fetched > 0 or error is not None:
+                latency = (time.perf_counter() - started_at) * DownloadScheduler._LATENCY_BYTES / max(fetched, 1)
+            self._controller.release(latency, error is None)
+        return error
+
+
+    def _fetch(self, url, download, segment):
+        with metrics.track('download'):
+            self._downloader.fetch_segment(download, segment, self._bandwidth)
+
+
+    def _complete(self, download):
+        self._downloader.report('finish', download.name)
+        if download.error is None:
+            try:
+                self._downloader.finish(download)
+            except Exception as e:
+                download.error = e
+        if download.error is None:
+            if self._on_complete is not None:
+                try:
+                    self._on_complete(download)
+                except Exception as e:
+                    DownloadScheduler._LOGGER.warning(f'Post processing {download.name} failed: {e}')
+            self._deliver(download)
+            return
+        # Whatever made it to disk is kept for the next run to resume from.
+        try:
+            Downloader.save_segments(download)
+        except OSError as e:
+            DownloadScheduler._LOGGER.warning(f'Saving the state of {download.name} failed: {e}')
+        error = download.error
+        if not isinstance(error, RetryError):
+            error = RetryError(download.url, 1, error)
+        self._fail(download.url, download.item, error)
+
+
+    def _settle(self, download):
+        try:
+            self._complete(download)
+        except Exception as e:
+            DownloadScheduler._LOGGER.error(f'Completing {download.name} failed: {e}')
+
+
+    def results(self, jobs):
+        feeder = threading.Thread(target=self._feed, args=(jobs,))
+        feeder.daemon = True
+        workers = [threading.Thread(target=self._worker) for _ in range(self._connections)]
+        feeder.start()
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        finished_count = 0
+        while finished_count < len(workers):
+            result = self._results.get()
+            if result is DownloadScheduler._STOP:
+                finished_count += 1
+                continue
+            yield result
+        for worker in workers:
+            worker.join()
+        feeder.join()
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import time
+import zlib
+import atexit
+import sqlite3
+import logging
+import threading
+from collections import namedtuple
+from . import config
+from . import metrics
+
+__all__ = ['HttpCache', 'CachedPage', 'get_cache', 'close']
+
+CachedPage = namedtuple('CachedPage', ['text', 'etag', 'last_modified', 'fetched_at'])
+
+
+class HttpCache:
+
+    DB_FILE = 'http-cache.db'
+
+    # Eviction goes a bit below the cap, so that not every store after the
+    # cache filled up has to evict again.
+    _EVICT_TO_FRACTION = 0.9
+    # Reads are not writes: the access times of looked up pages are kept in
+    # memory and written with the next store, or once this many piled up.
+    # Losing them costs nothing but a less accurate eviction order.
+    _ACCESS_FLUSH_COUNT = 1000
+    _BUSY_TIMEOUT = 30.0
+    _LOGGER = logging.getLogger(__name__)
+
+    SQL_CREATE_PAGE_TABLE = '''
+        CREATE TABLE IF NOT EXISTS page (
+            url text PRIMARY KEY,
+            etag text,
+            last_modified text,
+            body blob NOT NULL,
+            size integer NOT NULL,
+            fetched_at real NOT NULL,
+            accessed_at real NOT NULL
+        );
+    '''
+    SQL_CREATE_ACCESSED_AT_INDEX = '''
+        CREATE INDEX IF NOT EXISTS page_accessed_at ON page (accessed_at);
+    '''
+
+
+    def __init__(self, path=None, ttl=None, max_size=None):
+        self._ttl = config.get('cache_ttl') if ttl is None else ttl
+        self._max_size = max_size or config.get('cache_max_size') * 1024 * 1024
+        self._lock = threading.Lock()
+        self._accessed = {}
+        self._conn = sqlite3.connect(
+            path or HttpCache.DB_FILE,
+            timeout=HttpCache._BUSY_TIMEOUT,
+            check_same_thread=False,
+        )
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(HttpCache.SQL_CREATE_PAGE_TABLE)
+        self._conn.execute(HttpCache.SQL_CREATE_ACCESSED_AT_INDEX)
+        self._conn.commit()
+        self._total_size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM page').fetchone()[0]
+
+
+    # The cache only ever saves requests: a page it cannot read is a miss,
+    # and one it cannot write is fetched again next time.
+    def lookup(self, url):
+        try:
+            page = self._lookup(url)
+        except (sqlite3.Error, zlib.error, UnicodeDecodeError) as e:
+            HttpCache._LOGGER.warning(f'Http cache lookup of {url} failed: {e}')
+            page = None
+        if page is None:
+            metrics.inc(metrics.HTTP_CACHE_TOTAL, result='miss')
+        return page
+
+
+    def _lookup(self, url):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT body, etag, last_modified, fetched_at FROM page WHERE url = ?', (url,)
+            ).fetchone()
+            if row is not None:
+                self._accessed[url] = time.time()
+                if len(self._accessed) >= HttpCache._ACCESS_FLUSH_COUNT:
+                    self._flush_accessed()
+                    self._conn.commit()
+        if row is None:
+            return None
+        body, etag, last_modified, fetched_at = row
+        return CachedPage(zlib.decompress(body).decode('utf-8'), etag, last_modified, fetched_at)
+
+
+    def is_fresh(self, page):
+        fresh = time.time() - page.fetched_at < self._ttl
+        metrics.inc(metrics.HTTP_CACHE_TOTAL, result='fresh' if fresh else 'stale')
+        return fresh
+
+
+    @staticmethod
+    def conditional_headers(page):
+        headers = {}
+        if page is None:
+            return headers
+        if page.etag:
+            headers['If-None-Match'] = page.etag
+        if page.last_modified:
+            headers['If-Modified-Since'] = page.last_modified
+        return headers
+
+
+    def revalidated(self, url):
+        metrics.inc(metrics.HTTP_CACHE_TOTAL, result='revalidated')
+        now = time.time()
+        with self._lock:
+            self._accessed.pop(url, None)
+            try:
+                self._conn.execute('UPDATE page SET fetched_at = ?, accessed_at = ? WHERE url = ?', (now, now, url))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._rollback()
+                HttpCache._LOGGER.warning(f'Http cache update of {url} failed: {e}')
+
+
+    def store(self, url, text, headers):
+        body = zlib.compress(text.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self._accessed.pop(url, None)
+            total_size = self._total_size
+            try:
+                self._flush_accessed()
+                previous = self._conn.execute('SELECT size FROM page WHERE url = ?', (url,)).fetchone()
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO page VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (url, headers.get('ETag'), headers.get('Last-Modified'), body, len(body), now, now)
+                )
+                self._total_size += len(body) - (previous[0] if previous else 0)
+                if self._total_size > self._max_size:
+                    self._evict()
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._total_size = total_size
+                self._rollback()
+                HttpCache._LOGGER.warning(f'Http cache store of {url} failed: {e}')
+
+
+    def _rollback(self):
+        try:
+            self._conn.rollback()
+        except sqlite3.Error:
+            pass
+
+
+    def _flush_accessed(self):
+        if not self._accessed:
+            return
+        self._conn.executemany(
+            'UPDATE page SET accessed_at = ? WHERE url = ?',
+            ((accessed_at, url) for url, accessed_at in self._accessed.items())
+        )
+        self._accessed.clear()
+
+
+    def _evict(self):
+        target_size = self._max_size * HttpCache._EVICT_TO_FRACTION
+        evicted_urls = []
+        for url, size in self._conn.execute('SELECT url, size FROM page ORDER BY accessed_at'):
+            if self._total_size <= target_size:
+                break
+            evicted_urls.append((url,))
+            self._total_size -= size
+        self._conn.executemany('DELETE FROM page WHERE url = ?', evicted_urls)
+        HttpCache._LOGGER.info(f'Evicted {len(evicted_urls)} pages from the http cache')
+
+
+    def close(self):
+        with self._lock:
+            try:
+                self._flush_accessed()
+                self._conn.commit()
+            except sqlite3.Error as e:
+                HttpCache._LOGGER.warning(f'Http cache flush failed: {e}')
+            self._conn.close()
+
+
+_lock = threading.Lock()
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if not config.get('http_cache'):
+        return None
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                try:
+                    _cache = HttpCache()
+                except sqlite3.Error as e:
+                    # Crawling goes on without a cache rather than not at all.
+                    HttpCache._LOGGER.warning(f'Http cache unavailable: {e}')
+                    config.assign('http_cache', False)
+                    return None
+                atexit.register(close)
+    return _cache
+
+
+def close():
+    global _cache
+    with _lock:
+        if _cache is not None:
+            _cache.close()
+            _cache = None
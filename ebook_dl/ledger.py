@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import json
+import logging
+import threading
+import requests
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from . import config
+from . import metrics
+from .db import Db, BookInfo, BookUrl, get_db
+
+__all__ = ['Ledger', 'RemoteLedger', 'lease_key', 'serve', 'get_ledger']
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _encode(stage, items):
+    if stage == Db.PROFILE_STAGE:
+        return [
+            item if isinstance(item, str) else [getattr(item, slot) for slot in BookInfo.__slots__]
+            for item in items
+        ]
+    return [item.to_row() for item in items]
+
+
+def _decode(stage, rows, results=False):
+    # Claimed profile rows are urls, their results book info.
+    if stage == Db.PROFILE_STAGE:
+        return [BookInfo(*row) for row in rows] if results else list(rows)
+    return [BookUrl.from_row(row) for row in rows]
+
+
+def lease_key(stage, item):
+    return item if stage == Db.PROFILE_STAGE else item.tn_url
+
+
+class Ledger:
+
+    # The work of a sharded crawl, kept in the local db. The coordinator
+    # serves it to remote workers, workers on the machine of the db can
+    # share it directly.
+
+    def __init__(self, db=None, lease_ttl=None):
+        self._db = db or get_db()
+        self.lease_ttl = lease_ttl or config.get('lease_ttl')
+        if self._db.dedup:
+            metrics.inc(metrics.DUPLICATES_TOTAL, self._db.mark_duplicate_profile_urls(), kind='profile')
+
+
+    def claim(self, stage, worker, count):
+        rows = self._db.lease_rows(stage, worker, count, self.lease_ttl)
+        if stage == Db.PROFILE_STAGE:
+            return [row[0] for row in rows]
+        book_urls = [BookUrl.from_row(row) for row in rows]
+        if stage == Db.RESOURCE_URL_STAGE:
+            # Resolved before and not expired, the worker has nothing to ask.
+            for book_url in book_urls:
+                book_url.resource_url = book_url.resource_url or self._db.lookup_resolution(book_url.tn_url)
+        return book_urls
+
+
+    def complete(self, stage, worker, keys, results, failures=()):
+        # The leased rows without a result failed, with the failures the
+        # worker recorded or else for no reason known.
+        keys = list(keys)
+        with self._db.transaction('complete leases'):
+            for failure in failures:
+                self._db.store_failure(*failure)
+            if stage == Db.PROFILE_STAGE:
+                self._db.insert_book_info_collection(results)
+                self._db.mark_profile_urls_done(book_info.profile_url for book_info in results)
+            elif stage == Db.RESOURCE_URL_STAGE:
+                self._db.update_book_url_collection(results)
+                # A tn_url failing for the worker every time, e.g. for an
+                # answer it cannot parse, backs off like one that resolved
+                # to nothing instead of being leased again right away.
+                resolved = {book_url.tn_url for book_url in results}
+                self._db.store_resolutions([BookUrl(tn_url=key) for key in keys if key not in resolved])
+            else:
+                self._db.mark_books_downloaded(book_url.tn_url for book_url in results)
+            self._db.finish_leases(stage, worker, keys, f'no result from worker {worker}')
+
+
+    def heartbeat(self, worker):
+        self._db.renew_leases(worker, self.lease_ttl)
+
+
+    def store_content(self, size, sha256, path):
+        return self._db.store_content(size, sha256, path)
+
+
+    def replace_content_path(self, size, sha256, path):
+        self._db.replace_content_path(size, sha256, path)
+
+
+    def leave(self, worker):
+        self._db.remove_worker(worker)
+
+
+    def status(self):
+        return {
+            'workers': self._db.count_workers(self.lease_ttl),
+            'leases': self._db.count_leases(),
+        }
+
+
+class RemoteLedger:
+
+    # The Ledger of a coordinator, see serve(). A remote worker has no db of
+    # its own, the scraper records its failures and downloaded content here
+    # as it would in the db (see Scraper._store). Failures go to the
+    # coordinator with the batch they belong to.
+
+    _TIMEOUT = 30
+
+    def __init__(self, url):
+        self._url = url.rstrip('/')
+        self._session = requests.Session()
+        self._failures = []
+        self._lock = threading.Lock()
+
+
+    def _post(self, action, **payload):
+        response = self._session.post(f'{self._url}/{action}', json=payload, timeout=RemoteLedger._TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+
+    def claim(self, stage, worker, count):
+        rows = self._post('claim', stage=stage, worker=worker, count=count)['rows']
+        return _decode(stage, rows)
+
+
+    def complete(self, stage, worker, keys, results):
+        with self._lock:
+            failures, self._failures = self._failures, []
+        self._post(
+            'complete', stage=stage, worker=worker, keys=list(keys), results=_encode(stage, results),
+            failures=failures
+        )
+
+
+    def heartbeat(self, worker):
+        self._post('heartbeat', worker=worker)
+
+
+    def leave(self, worker):
+        self._post('leave', worker=worker)
+
+
+    def status(self):
+        return self._post('status')
+
+
+    def store_failure(self, stage, key, attempts, error):
+        with self._lock:
+            self._failures.append([stage, key, attempts, error])
+
+
+    def lookup_resolution(self, tn_url):
+        # The coordinator filled in the cached resolutions when the rows
+        # were claimed.
+        return ''
+
+
+    def store_content(self, size, sha256, path):
+        return self._post('store_content', size=size, sha256=sha256, path=path)['path']
+
+
+    def replace_content_path(self, size, sha256, path):
+        self._post('replace_content_path', size=size, sha256=sha256, path=path)
+
+
+class _LedgerHandler(BaseHTTPRequestHandler):
+
+    def _dispatch(self, action, payload):
+        ledger = self.server.ledger
+        if action == 'claim':
+            items = ledger.claim(payload['stage'], payload['worker'], payload['count'])
+            return {'rows': _encode(payload['stage'], items)}
+        if action == 'complete':
+            results = _decode(payload['stage'], payload['results'], results=True)
+            ledger.complete(
+                payload['stage'], payload['worker'], payload['keys'], results, payload.get('failures', ())
+            )
+            return {}
+        if action == 'heartbeat':
+            ledger.heartbeat(payload['worker'])
+            return {}
+        if action == 'leave':
+            ledger.leave(payload['worker'])
+            return {}
+        if action == 'status':
+            return ledger.status()
+        if action == 'store_content':
+            return {'path': ledger.store_content(payload['size'], payload['sha256'], payload['path'])}
+        if action == 'replace_content_path':
+            ledger.replace_content_path(payload['size'], payload['sha256'], payload['path'])
+            return {}
+        return None
+
+
+    def do_POST(self):
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            response = self._dispatch(self.path.strip('/'), payload)
+        except (ValueError, KeyError) as e:
+            self.send_error(400, str(e))
+            return
+        if response is None:
+            self.send_error(404)
+            return
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        _LOGGER.debug(format % args)
+
+
+def serve(port, host='127.0.0.1', ledger=None):
+    server = ThreadingHTTPServer((host, port), _LedgerHandler)
+    server.daemon_threads = True
+    server.ledger = ledger or Ledger()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    _LOGGER.info(f'Serving the ledger on http://{host}:{server.server_address[1]}')
+    return server
+
+
+_lock = threading.Lock()
+_ledger = None
+
+
+def get_ledger():
+    global _ledger
+    if _ledger is None:
+        with _lock:
+            if _ledger is None:
+                coordinator = config.get('coordinator')
+                _ledger = RemoteLedger(coordinator) if coordinator else Ledger()
+    return _ledger
@@ -1,8 +1,15 @@
 #!/usr/bin/python3
 # -*- conding:utf-8 -*-
 
+import os
+import time
+import socket
 import typer
+from enum import Enum
 from . import config
+from . import parser
+from . import metrics
+from . import profiler
 from .scraper import Scraper
 
 app = typer.Typer()
@@ -10,33 +17,182 @@ app = typer.Typer()
 __all__ = ['run']
 
 
+class Engine(str, Enum):
+    thread = 'thread'
+    async_ = 'async'
+
+
+class HtmlParser(str, Enum):
+    lxml = 'lxml'
+    html_parser = 'html.parser'
+
+
+def _create_scraper():
+    if config.get('engine') == Engine.async_:
+        from .async_scraper import AsyncScraper
+        return AsyncScraper()
+    return Scraper()
+
+
+def _warn_thread_engine_only(command):
+    # The pipelined stages are built on ThreadManager, the async engine only
+    # runs the stage commands.
+    if config.get('engine') == Engine.async_:
+        typer.secho(
+            f'{command} has no async engine, it runs on threads. --engine async applies to '
+            'search, collect-book-info and resource-url.',
+            fg=typer.colors.YELLOW, err=True
+        )
+
+
+@app.callback()
+def main(
+    ctx: typer.Context,
+    main_url: str = typer.Option('', help='Site to scrape instead of itebooksfree.com, e.g. a local stand-in.'),
+    engine: Engine = typer.Option(Engine.thread, help='Crawl engine for the network bound stages.'),
+    concurrency: int = typer.Option(500, min=1, help='Concurrent requests of the async engine at most.'),
+    adaptive_concurrency: bool = typer.Option(True, help='Adjust the workers of every stage to the latency and errors seen.'),
+    min_concurrency: int = typer.Option(4, min=1, help='Workers per stage the adaptive concurrency keeps at least.'),
+    max_concurrency: int = typer.Option(0, min=0, help='Threads per stage at most, 0 for the defaults of 100 to 200.'),
+    max_connections_per_host: int = typer.Option(64, min=1, help='Keep-alive connection cap per host.'),
+    max_attempts: int = typer.Option(5, min=1, help='Attempts per request before it is recorded as failed.'),
+    rate_limit: float = typer.Option(20.0, min=0, help='Requests per second over all stages, 0 to disable.'),
+    burst: int = typer.Option(10, min=1, help='Requests allowed in a burst above the rate limit.'),
+    checkpoint_every: int = typer.Option(200, min=1, help='Commit results to the db every N items...'),
+    checkpoint_seconds: float = typer.Option(5.0, min=0.1, help='...or every T seconds, whichever comes first.'),
+    html_parser: HtmlParser = typer.Option(HtmlParser(parser.DEFAULT_BACKEND), help='HTML parser, lxml is used when installed.'),
+    process_parse: bool = typer.Option(False, help='Parse pages in a process per core, leaving the fetchers to I/O only.'),
+    download_connections: int = typer.Option(4, min=1, help='Range request connections per downloaded file.'),
+    max_download_connections: int = typer.Option(32, min=1, help='Download connections over all files.'),
+    download_rate_limit: float = typer.Option(0.0, min=0, help='Download bandwidth cap in KiB/s, 0 to disable.'),
+    http_cache: bool = typer.Option(True, help='Cache listing and profile pages and revalidate them with conditional requests.'),
+    cache_ttl: float = typer.Option(3600.0, min=0, help='Seconds a cached page is used without asking the server.'),
+    cache_size: int = typer.Option(256, min=1, help='Http cache size cap in MiB, least recently used pages go first.'),
+    resolve_ttl: float = typer.Option(7 * 24 * 3600.0, min=0, help='Seconds a resolved resource url is reused without asking the site.'),
+    resolve_backoff: float = typer.Option(3600.0, min=0, help='Seconds before a failed tn_url is tried again, doubled after every failure.'),
+    dedup: bool = typer.Option(True, help='Fetch one profile page per book name and hard link downloads with the same content.'),
+    dashboard: bool = typer.Option(False, help='Show live throughput and latency per operation.'),
+    metrics_port: int = typer.Option(0, min=0, help='Serve Prometheus metrics on 127.0.0.1:PORT/metrics, 0 to disable.'),
+    metrics_json: str = typer.Option('', help='Write a json summary of the metrics to this file at exit.'),
+    profile: str = typer.Option('', help='Sample cpu per stage, and write a report to this file at exit.'),
+    profile_allocations: bool = typer.Option(False, help='Also trace allocations for --profile, this slows the run down several times.'),
+) -> None:
+    config.assign('main_url', main_url)
+    config.assign('engine', engine)
+    config.assign('concurrency', concurrency)
+    config.assign('adaptive_concurrency', adaptive_concurrency)
+    config.assign('min_concurrency', min_concurrency)
+    config.assign('max_concurrency', max_concurrency)
+    config.assign('pool_maxsize', max_connections_per_host)
+    config.assign('max_attempts', max_attempts)
+    config.assign('rate_limit', rate_limit)
+    config.assign('rate_burst', burst)
+    config.assign('write_batch_size', checkpoint_every)
+    config.assign('write_interval', checkpoint_seconds)
+    config.assign('html_parser', html_parser.value)
+    config.assign('process_parse', process_parse)
+    config.assign('download_connections', download_connections)
+    config.assign('max_download_connections', max_download_connections)
+    config.assign('download_rate_limit', download_rate_limit)
+    config.assign('http_cache', http_cache)
+    config.assign('cache_ttl', cache_ttl)
+    config.assign('cache_max_size', cache_size)
+    config.assign('resolve_ttl', resolve_ttl)
+    config.assign('resolve_backoff', resolve_backoff)
+    config.assign('dedup', dedup)
+    config.assign('dashboard', dashboard)
+    config.assign('metrics_port', metrics_port)
+    config.assign('metrics_json', metrics_json)
+    config.assign('profile', profile)
+    config.assign('profile_allocations', profile_allocations)
+    metrics.start()
+    ctx.call_on_close(metrics.stop)
+    profiler.start()
+    ctx.call_on_close(profiler.stop)
+
+
 @app.command()
-def collect_book_info() -> None:
-    scraper = Scraper()
-    scraper.collect_book_info()
+def collect_book_info(
+    retry_failed: bool = typer.Option(False, help='Only re-fetch the profile pages that failed before.'),
+) -> None:
+    scraper = _create_scraper()
+    scraper.collect_book_info(retry_failed)
 
 
 @app.command()
 def search(
     keyword: str = typer.Argument(''),
+    incremental: bool = typer.Option(False, help='Walk the pages from the newest and stop at the first one already known.'),
 ) -> None:
     config.assign('keyword', keyword)
-    scraper = Scraper()
-    scraper.get_all_book_profile_page_urls()
+    scraper = _create_scraper()
+    scraper.get_all_book_profile_page_urls(incremental)
 
 
 @app.command()
 def resource_url() -> None:
-    scraper = Scraper()
+    scraper = _create_scraper()
     scraper.collect_all_resource_urls()
 
 
 @app.command()
-def download_all() -> None:
+def crawl(
+    keyword: str = typer.Argument(''),
+    incremental: bool = typer.Option(False, help='Walk the pages from the newest and stop at the first one already known.'),
+) -> None:
+    config.assign('keyword', keyword)
+    _warn_thread_engine_only('crawl')
     scraper = Scraper()
+    scraper.crawl(incremental)
+
+
+@app.command()
+def download_all() -> None:
+    scraper = _create_scraper()
     scraper.download_all_books()
 
 
+@app.command()
+def coordinator(
+    port: int = typer.Option(8780, min=1, help='Port to serve the work ledger on.'),
+    host: str = typer.Option('127.0.0.1', help='Address to serve the work ledger on, 0.0.0.0 for other machines.'),
+    lease_ttl: float = typer.Option(60.0, min=3, help='Seconds a claimed batch stays leased without a heartbeat.'),
+) -> None:
+    # Serves the rows of the local db to `worker --coordinator` processes,
+    # run search first to fill it.
+    from . import ledger
+    config.assign('lease_ttl', lease_ttl)
+    server = ledger.serve(port, host)
+    typer.echo(f'Serving the work ledger on http://{host}:{server.server_address[1]}, Ctrl-C to stop.')
+    try:
+        with config.get('console').status('[bold green]coordinating...') as status:
+            while True:
+                ledger_status = server.ledger.status()
+                status.update(f'[bold green]coordinating... workers: {ledger_status["workers"]}, leased: ' + ', '.join(
+                    f'{stage}: {count}' for stage, count in ledger_status['leases'].items()
+                ))
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+@app.command()
+def worker(
+    coordinator: str = typer.Option('', help='Url of the coordinator, by default the local db is shared with the other workers.'),
+    worker_id: str = typer.Option('', help='Name of this worker, host and pid by default.'),
+    batch_size: int = typer.Option(100, min=1, help='Rows claimed at a time.'),
+    lease_ttl: float = typer.Option(60.0, min=3, help='Seconds a claimed batch stays leased without a heartbeat.'),
+) -> None:
+    from .ledger import get_ledger
+    from .worker import Worker
+    config.assign('coordinator', coordinator)
+    config.assign('lease_ttl', lease_ttl)
+    _warn_thread_engine_only('worker')
+    Worker(get_ledger(), worker_id or f'{socket.gethostname()}-{os.getpid()}', batch_size).run()
+
+
 def run() -> None:
     config.init()
     config.config_logging()
@@ -0,0 +1,455 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import json
+import math
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from rich.live import Live
+from rich.table import Table
+from . import config
+
+__all__ = [
+    'Counter', 'Gauge', 'Histogram', 'Registry', 'Dashboard',
+    'get_registry', 'inc', 'track', 'track_async', 'current_stage', 'thread_stages',
+    'serve', 'write_summary', 'start', 'stop',
+]
+
+OPERATIONS_TOTAL = 'ebook_dl_operations_total'
+OPERATION_SECONDS = 'ebook_dl_operation_seconds'
+IN_FLIGHT = 'ebook_dl_in_flight'
+BYTES_TOTAL = 'ebook_dl_bytes_total'
+RETRIES_TOTAL = 'ebook_dl_retries_total'
+THROTTLED_TOTAL = 'ebook_dl_throttled_total'
+CIRCUIT_OPEN_TOTAL = 'ebook_dl_circuit_open_total'
+REQUEST_RATE = 'ebook_dl_request_rate'
+CONCURRENCY_LIMIT = 'ebook_dl_concurrency_limit'
+HTTP_CACHE_TOTAL = 'ebook_dl_http_cache_total'
+DB_ROWS_TOTAL = 'ebook_dl_db_rows_total'
+DUPLICATES_TOTAL = 'ebook_dl_duplicates_total'
+
+_HELP = {
+    OPERATIONS_TOTAL: 'Finished operations by operation and outcome.',
+    OPERATION_SECONDS: 'Operation latency in seconds.',
+    IN_FLIGHT: 'Operations currently running.',
+    BYTES_TOTAL: 'Bytes received by operation.',
+    RETRIES_TOTAL: 'Failed attempts that were retried.',
+    THROTTLED_TOTAL: 'Times the server throttled and the request rate was lowered.',
+    CIRCUIT_OPEN_TOTAL: 'Times a host circuit breaker opened.',
+    REQUEST_RATE: 'Current request rate of the rate limiter per second.',
+    CONCURRENCY_LIMIT: 'Current number of jobs a stage runs at once.',
+    HTTP_CACHE_TOTAL: 'Http cache lookups by result.',
+    DB_ROWS_TOTAL: 'Rows handed to the db writer.',
+    DUPLICATES_TOTAL: 'Profile pages, downloads and files skipped or linked as duplicates.',
+}
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Counter:
+
+    TYPE = 'counter'
+
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+
+    @property
+    def value(self):
+        return self._value
+
+
+class Gauge:
+
+    TYPE = 'gauge'
+
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+    def set(self, value):
+        self._value = value
+
+
+    @property
+    def value(self):
+        return self._value
+
+
+class Histogram:
+
+    TYPE = 'histogram'
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+
+    def __init__(self):
+        self._bucket_counts = [0] * len(Histogram.BUCKETS)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+
+    def observe(self, value):
+        index = bisect.bisect_left(Histogram.BUCKETS, value)
+        with self._lock:
+            self._bucket_counts[index] += 1
+            self._count += 1
+            self._sum += value
+
+
+    @property
+    def count(self):
+        return self._count
+
+
+    @property
+    def sum(self):
+        return self._sum
+
+
+    def cumulative_counts(self):
+        with self._lock:
+            bucket_counts = list(self._bucket_counts)
+        total = 0
+        for bound, count in zip(Histogram.BUCKETS, bucket_counts):
+            total += count
+            yield bound, total
+
+
+    def quantile(self, fraction):
+        # Interpolated inside the bucket holding the quantile, like
+        # Prometheus' histogram_quantile.
+        if self._count == 0:
+            return None
+        rank = fraction * self._count
+        lower_bound, lower_count = 0.0, 0
+        for bound, count in self.cumulative_counts():
+            if count >= rank:
+                if math.isinf(bound):
+                    return lower_bound
+                return lower_bound + (bound - lower_bound) * (rank - lower_count) / max(count - lower_count, 1)
+            lower_bound, lower_count = bound, count
+        return lower_bound
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+
+    def _get(self, metric_class, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, metric_class())
+        return metric
+
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+
+    def gauge(self, name, **labels):
+        return self._get(Gauge, name, labels)
+
+
+    def histogram(self, name, **labels):
+        return self._get(Histogram, name, labels)
+
+
+    def collect(self, name=None):
+        with self._lock:
+            items = sorted(self._metrics.items(), key=lambda item: item[0])
+        for (metric_name, labels), metric in items:
+            if name is None or metric_name == name:
+                yield metric_name, dict(labels), metric
+
+
+    def total(self, name, **labels):
+        return sum(
+            metric.value for _, metric_labels, metric in self.collect(name)
+            if all(metric_labels.get(key) == value for key, value in labels.items())
+        )
+
+
+    @staticmethod
+    def _format_labels(labels, **extra_labels):
+        labels = dict(labels, **extra_labels)
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+    def to_prometheus(self):
+        lines = []
+        described = set()
+        for name, labels, metric in self.collect():
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {_HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} {metric.TYPE}')
+            if metric.TYPE != Histogram.TYPE:
+                lines.append(f'{name}{Registry._format_labels(labels)} {metric.value}')
+                continue
+            for bound, count in metric.cumulative_counts():
+                le = '+Inf' if math.isinf(bound) else repr(bound)
+                lines.append(f'{name}_bucket{Registry._format_labels(labels, le=le)} {count}')
+            lines.append(f'{name}_sum{Registry._format_labels(labels)} {metric.sum}')
+            lines.append(f'{name}_count{Registry._format_labels(labels)} {metric.count}')
+        return '\n'.join(lines) + '\n'
+
+
+    def to_dict(self):
+        summary = {'elapsed_seconds': time.time() - self.started_at, 'metrics': []}
+        for name, labels, metric in self.collect():
+            entry = {'name': name, 'labels': labels}
+            if metric.TYPE == Histogram.TYPE:
+                entry.update(
+                    count=metric.count,
+                    sum=metric.sum,
+                    p50=metric.quantile(0.5),
+                    p99=metric.quantile(0.99),
+                )
+            else:
+                entry['value'] = metric.value
+            summary['metrics'].append(entry)
+        return summary
+
+
+_lock = threading.Lock()
+_registry = None
+_thread_stages = {}
+_dashboard = None
+_server = None
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        with _lock:
+            if _registry is None:
+                _registry = Registry()
+    return _registry
+
+
+def inc(name, amount=1, **labels):
+    get_registry().counter(name, **labels).inc(amount)
+
+
+# The stage marker of a thread is what it is tracked as doing right now,
+# other threads (e.g. a sampling profiler) may read it by thread id.
+def current_stage():
+    return _thread_stages.get(threading.get_ident())
+
+
+def thread_stages():
+    return dict(_thread_stages)
+
+
+def _observe(registry, operation, start, outcome):
+    registry.histogram(OPERATION_SECONDS, operation=operation).observe(time.perf_counter() - start)
+    registry.counter(OPERATIONS_TOTAL, operation=operation, outcome=outcome).inc()
+
+
+@contextmanager
+def track(operation):
+    registry = get_registry()
+    in_flight = registry.gauge(IN_FLIGHT, operation=operation)
+    thread_id = threading.get_ident()
+    previous_stage = _thread_stages.get(thread_id)
+    _thread_stages[thread_id] = operation
+    in_flight.inc()
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        in_flight.dec()
+        _observe(registry, operation, start, outcome)
+        if previous_stage is None:
+            _thread_stages.pop(thread_id, None)
+        else:
+            _thread_stages[thread_id] = previous_stage
+
+
+# Coroutines share their thread, so they are not given a stage marker.
+@asynccontextmanager
+async def track_async(operation):
+    registry = get_registry()
+    in_flight = registry.gauge(IN_FLIGHT, operation=operation)
+    in_flight.inc()
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'ok'
+    finally:
+        in_flight.dec()
+        _observe(registry, operation, start, outcome)
+
+
+def _format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            return f'{size:.1f}{unit}'
+        size /= 1024
+
+
+def _format_seconds(seconds):
+    return '-' if seconds is None else f'{seconds * 1000:.0f}ms'
+
+
+class Dashboard:
+
+    _REFRESH_PER_SECOND = 2
+
+
+    def __init__(self, console, registry=None):
+        self._console = console
+        self._registry = registry or get_registry()
+        self._live = None
+        self._previous_counts = {}
+        self._previous_at = time.monotonic()
+
+
+    def _rates(self, counts):
+        # Throughput over the last refresh, not since the start.
+        now = time.monotonic()
+        elapsed = max(now - self._previous_at, 1e-6)
+        rates = {
+            key: (count - self._previous_counts.get(key, 0)) / elapsed
+            for key, count in counts.items()
+        }
+        self._previous_counts = counts
+        self._previous_at = now
+        return rates
+
+
+    def __rich__(self):
+        registry = self._registry
+        operations = sorted({labels['operation'] for _, labels, _ in registry.collect(OPERATION_SECONDS)})
+        counts = {operation: registry.total(OPERATIONS_TOTAL, operation=operation) for operation in operations}
+        counts.update({
+            ('bytes', operation): registry.total(BYTES_TOTAL, operation=operation)
+            for operation in operations
+        })
+        rates = self._rates(counts)
+        table = Table(title='ebook-dl metrics', header_style='magenta')
+        table.add_column('Operation', no_wrap=True)
+        for column in ('Done', 'Errors', 'Active', 'Per s', 'p50', 'p99', 'Bytes', 'Bytes/s'):
+            table.add_column(column, justify='right', no_wrap=True)
+        for operation in operations:
+            histogram = registry.histogram(OPERATION_SECONDS, operation=operation)
+            table.add_row(
+                operation,
+                str(counts[operation]),
+                str(registry.total(OPERATIONS_TOTAL, operation=operation, outcome='error')),
+                str(registry.total(IN_FLIGHT, operation=operation)),
+                f'{rates[operation]:.1f}',
+                _format_seconds(histogram.quantile(0.5)),
+                _format_seconds(histogram.quantile(0.99)),
+                _format_bytes(counts[('bytes', operation)]),
+                _format_bytes(rates[('bytes', operation)]),
+            )
+        table.caption = (
+            f'retries {registry.total(RETRIES_TOTAL)}  '
+            f'throttled {registry.total(THROTTLED_TOTAL)}  '
+            f'circuits opened {registry.total(CIRCUIT_OPEN_TOTAL)}  '
+            f'request rate {registry.total(REQUEST_RATE):.1f}/s  '
+            'concurrency ' + ' '.join(
+                f'{labels["stage"]} {metric.value:.0f}' for _, labels, metric in registry.collect(CONCURRENCY_LIMIT)
+            )
+        )
+        return table
+
+
+    def start(self):
+        self._live = Live(self, console=self._console, refresh_per_second=Dashboard._REFRESH_PER_SECOND)
+        self._live.start()
+
+
+    def stop(self):
+        if self._live is not None:
+            self._live.stop()
+            self._live = None
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = get_registry().to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host='127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    _LOGGER.info(f'Serving metrics on http://{host}:{server.server_address[1]}/metrics')
+    return server
+
+
+def write_summary(path):
+    with open(path, 'w') as summary_file:
+        json.dump(get_registry().to_dict(), summary_file, indent=2)
+
+
+def start():
+    global _dashboard, _server
+    if config.get('dashboard'):
+        _dashboard = Dashboard(config.get('console'))
+        _dashboard.start()
+    if config.get('metrics_port'):
+        _server = serve(config.get('metrics_port'))
+
+
+def stop():
+    global _dashboard, _server
+    if _dashboard is not None:
+        _dashboard.stop()
+        _dashboard = None
+    if _server is not None:
+        _server.shutdown()
+        _server = None
+    if config.get('metrics_json'):
+        write_summary(config.get('metrics_json'))
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import os
+import atexit
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from . import config
+from . import metrics
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml
+    DEFAULT_BACKEND = 'lxml'
+except ImportError:
+    DEFAULT_BACKEND = 'html.parser'
+
+__all__ = [
+    'LISTING_PAGE', 'PROFILE_PAGE', 'DEFAULT_BACKEND',
+    'make_soup', 'parse', 'parse_async',
+]
+
+LISTING_PAGE = 'listing'
+PROFILE_PAGE = 'profile'
+
+# Only the subtrees the scraper reads are turned into a tree, the rest of
+# the page is skipped by the parser.
+_STRAINERS = {
+    LISTING_PAGE: SoupStrainer('div', attrs={'class': ['card-body', 'pagination']}),
+    PROFILE_PAGE: SoupStrainer('section', attrs={'class': 'content'}),
+}
+
+_lock = threading.Lock()
+_process_pool = None
+
+
+def get_backend():
+    return config.get('html_parser') or DEFAULT_BACKEND
+
+
+def make_soup(page_text, page_type=None, backend=None):
+    return BeautifulSoup(
+        page_text,
+        backend or get_backend(),
+        parse_only=_STRAINERS.get(page_type),
+    )
+
+
+def get_process_pool():
+    global _process_pool
+    if not config.get('process_parse'):
+        return None
+    if _process_pool is None:
+        with _lock:
+            if _process_pool is None:
+                _process_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+                atexit.register(shutdown_process_pool)
+    return _process_pool
+
+
+def shutdown_process_pool():
+    global _process_pool
+    with _lock:
+        if _process_pool is not None:
+            _process_pool.shutdown()
+            _process_pool = None
+
+
+# parse_func must be picklable and take the raw page text and the backend
+# name, the config of the parent is not available in spawned processes.
+def parse(parse_func, page_text):
+    process_pool = get_process_pool()
+    with metrics.track('parse'):
+        if process_pool is None:
+            return parse_func(page_text, get_backend())
+        return process_pool.submit(parse_func, page_text, get_backend()).result()
+
+
+async def parse_async(parse_func, page_text):
+    process_pool = get_process_pool()
+    async with metrics.track_async('parse'):
+        if process_pool is None:
+            return parse_func(page_text, get_backend())
+        return await asyncio.get_running_loop().run_in_executor(
+            process_pool, parse_func, page_text, get_backend()
+        )
@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import os
+import sys
+import time
+import threading
+import functools
+import tracemalloc
+from collections import Counter, defaultdict
+from . import config
+from . import metrics
+
+__all__ = ['SamplingProfiler', 'start', 'stop']
+
+_OTHER_COMPONENT = 'python'
+_WAITING_COMPONENT = 'waiting'
+
+# Checked from the innermost frame outwards, the first file matching any of
+# the patterns names the component a sample or an allocation belongs to.
+_COMPONENTS = (
+    ('tomd', ('/tomd.py',)),
+    ('beautifulsoup', ('/bs4/', '/soupsieve/', '/lxml/', '/html/parser.py', '/_markupbase.py')),
+    ('sqlite', ('/sqlite3/', '/ebook_dl/db.py', '/ebook_dl/http_cache.py')),
+    ('network', (
+        '/requests/', '/urllib3/', '/aiohttp/', '/http/client.py', '/socket.py', '/ssl.py',
+        '/selectors.py',
+    )),
+    (_WAITING_COMPONENT, (
+        '/threading.py', '/queue.py', '/concurrent/futures/',
+        '/ebook_dl/rate_limiter.py', '/ebook_dl/retry.py',
+    )),
+)
+_NO_STAGE = '-'
+
+
+@functools.lru_cache(maxsize=None)
+def _component_of(filename):
+    filename = filename.replace(os.sep, '/')
+    for component, patterns in _COMPONENTS:
+        if any(pattern in filename for pattern in patterns):
+            return component
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _short_path(filename):
+    parts = filename.replace(os.sep, '/').split('/')
+    return '/'.join(parts[-2:])
+
+
+def _thread_cpu_time(native_id):
+    # Linux names the cpu clock of any thread of the process after its tid,
+    # and a thread gone meanwhile is an EINVAL instead of a stale pthread_t.
+    try:
+        return time.clock_gettime((~native_id << 3) | 6)
+    except (OSError, OverflowError):
+        return None
+
+
+class SamplingProfiler:
+
+    _INTERVAL = 0.01
+    # Tracing allocations slows every thread down, it is opt-in and only
+    # keeps the frame that allocated. One snapshot is taken at the end, what
+    # is still held then, next to the peak tracemalloc counted on the way.
+    _TRACEMALLOC_FRAMES = 1
+    _TOP_LINES = 8
+    _TOP_ALLOCATIONS = 15
+
+
+    def __init__(self, interval=None, trace_allocations=False):
+        self._interval = interval or SamplingProfiler._INTERVAL
+        self._trace_allocations = trace_allocations
+        self._wall_samples = Counter()
+        self._cpu_seconds = Counter()
+        self._line_cpu_seconds = Counter()
+        self._stage_threads = defaultdict(set)
+        self._cpu_times = {}
+        self._last_busy = {}
+        self._sample_count = 0
+        self._snapshot = None
+        self._traced_size = 0
+        self._peak_size = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._started_at = None
+        self._stopped_at = None
+        self._measure_cpu = sys.platform.startswith('linux')
+
+
+    def start(self):
+        if self._trace_allocations:
+            tracemalloc.start(SamplingProfiler._TRACEMALLOC_FRAMES)
+        self._started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+        self._stopped_at = time.perf_counter()
+        if self._trace_allocations:
+            self._traced_size, self._peak_size = tracemalloc.get_traced_memory()
+            self._snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            ))
+            tracemalloc.stop()
+
+
+    def _run(self):
+        while not self._stop_event.wait(self._interval):
+            self._sample()
+
+
+    @staticmethod
+    def _classify(frame):
+        location = None
+        while frame is not None:
+            code = frame.f_code
+            if location is None:
+                location = f'{_short_path(code.co_filename)}:{frame.f_lineno} {code.co_name}'
+            component = _component_of(code.co_filename)
+            if component is not None:
+                return component, location
+            frame = frame.f_back
+        return _OTHER_COMPONENT, location
+
+
+    def _cpu_delta(self, native_id):
+        if not self._measure_cpu or native_id is None:
+            return 0.0
+        cpu_time = _thread_cpu_time(native_id)
+        if cpu_time is None:
+            return 0.0
+        # The cpu a thread used since the previous sample goes to what it is
+        # seen doing now.
+        previous = self._cpu_times.get(native_id, cpu_time)
+        self._cpu_times[native_id] = cpu_time
+        return cpu_time - previous
+
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        native_ids = {thread.ident: thread.native_id for thread in threading.enumerate()}
+        stages = metrics.thread_stages()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stage = stages.get(thread_id, _NO_STAGE)
+            component, location = SamplingProfiler._classify(frame)
+            self._wall_samples[(stage, component)] += 1
+            self._stage_threads[stage].add(thread_id)
+            # A thread found waiting used the cpu since the previous sample
+            # on what it was last seen busy with, not on the waiting itself.
+            if component == _WAITING_COMPONENT and thread_id in self._last_busy:
+                stage, component, location = self._last_busy[thread_id]
+            else:
+                self._last_busy[thread_id] = (stage, component, location)
+            cpu_seconds = self._cpu_delta(native_ids.get(thread_id))
+            self._cpu_seconds[(stage, component)] += cpu_seconds
+            self._line_cpu_seconds[(stage, location)] += cpu_seconds
+        self._sample_count += 1
+
+
+    def _allocations_by_component(self):
+        sizes = Counter()
+        for trace in self._snapshot.traces:
+            components = (_component_of(frame.filename) for frame in reversed(trace.traceback))
+            sizes[next(filter(None, components), _OTHER_COMPONENT)] += trace.size
+        return sizes
+
+
+    def _allocation_lines(self):
+        if self._snapshot is None:
+            return ['', 'Allocations were not traced, see --profile-allocations.']
+        lines = [
+            '',
+            f'Memory: {self._peak_size / 1024 / 1024:.1f} MiB traced at the peak, '
+            f'{self._traced_size / 1024 / 1024:.1f} MiB still held at the end.',
+            'Allocations are not tied to threads, what is held at the end is grouped by the component '
+            'that allocated it.',
+            '',
+            f'{"component":<15} {"MiB":>8} {"%":>6}',
+        ]
+        component_sizes = self._allocations_by_component()
+        total_size = max(sum(component_sizes.values()), 1)
+        for component, size in component_sizes.most_common():
+            lines.append(f'{component:<15} {size / 1024 / 1024:>8.2f} {size / total_size * 100:>6.1f}')
+        lines += ['', 'Largest allocation sites']
+        for statistic in self._snapshot.statistics('lineno')[:SamplingProfiler._TOP_ALLOCATIONS]:
+            frame = statistic.traceback[0]
+            lines.append(
+                f'  {statistic.size / 1024 / 1024:8.2f} MiB {statistic.count:>8} blocks  '
+                f'{_short_path(frame.filename)}:{frame.lineno}'
+            )
+        return lines
+
+
+    def report(self):
+        elapsed = self._stopped_at - self._started_at
+        total_samples = max(sum(self._wall_samples.values()), 1)
+        total_cpu = sum(self._cpu_seconds.values())
+        stage_cpu = Counter()
+        for (stage, _), cpu_seconds in self._cpu_seconds.items():
+            stage_cpu[stage] += cpu_seconds
+        stage_samples = Counter()
+        for (stage, _), samples in self._wall_samples.items():
+            stage_samples[stage] += samples
+        stages = sorted(stage_samples, key=lambda stage: (-stage_cpu[stage], -stage_samples[stage]))
+        lines = [
+            f'ebook-dl profile: {elapsed:.1f}s wall, {total_cpu:.2f}s cpu sampled, '
+            f'{self._sample_count} samples every {self._interval * 1000:.0f}ms',
+            '',
+            'Stages are the operations threads are tracked in (see metrics.track), '
+            f'"{_NO_STAGE}" is everything else.',
+            'Wall % is the share of all thread samples, a thread waiting on the '
+            'network counts as much as one parsing.',
+        ]
+        if not self._measure_cpu:
+            lines.append('Per thread cpu time is only measured on Linux, the cpu columns are empty.')
+        lines += ['', f'{"stage":<14} {"component":<15} {"cpu s":>8} {"cpu %":>6} {"wall %":>7} {"threads":>8}']
+        for stage in stages:
+            components = sorted(
+                (component for (key_stage, component) in self._wall_samples if key_stage == stage),
+                key=lambda component: -self._cpu_seconds[(stage, component)]
+            )
+            for index, component in enumerate(components):
+                cpu_seconds = self._cpu_seconds[(stage, component)]
+                lines.append(
+                    f'{stage if index == 0 else "":<14} {component:<15} {cpu_seconds:>8.2f} '
+                    f'{cpu_seconds / total_cpu * 100 if total_cpu else 0:>6.1f} '
+                    f'{self._wall_samples[(stage, component)] / total_samples * 100:>7.1f} '
+                    f'{len(self._stage_threads[stage]) if index == 0 else "":>8}'
+                )
+        lines += ['', 'Busiest lines by stage (cpu s)']
+        for stage in stages:
+            stage_lines = sorted(
+                ((cpu_seconds, location) for (key_stage, location), cpu_seconds in self._line_cpu_seconds.items()
+                 if key_stage == stage and cpu_seconds > 0),
+                reverse=True
+            )[:SamplingProfiler._TOP_LINES]
+            if not stage_lines:
+                continue
+            lines.append(f'[{stage}]')
+            lines += [f'  {cpu_seconds:8.2f}  {location}' for cpu_seconds, location in stage_lines]
+        lines += self._allocation_lines()
+        return '\n'.join(lines) + '\n'
+
+
+_profiler = None
+
+
+def start():
+    global _profiler
+    if not config.get('profile'):
+        return
+    _profiler = SamplingProfiler(trace_allocations=config.get('profile_allocations'))
+    _profiler.start()
+
+
+def stop():
+    global _profiler
+    if _profiler is None:
+        return
+    _profiler.stop()
+    with open(config.get('profile'), 'w') as report_file:
+        report_file.write(_profiler.report())
+    config.get('console').print(f'Profile written to [bold]{config.get("profile")}[/bold]')
+    _profiler = None
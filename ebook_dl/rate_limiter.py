@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import time
+import asyncio
+import logging
+import threading
+from . import config
+from . import metrics
+
+__all__ = ['RateLimiter', 'get_rate_limiter']
+
+
+class RateLimiter:
+
+    THROTTLE_STATUS_CODES = (429, 503)
+
+    # AIMD: halve the rate on throttling (at most once per cooldown, since a
+    # burst of in-flight requests tends to come back throttled together),
+    # and win a small fraction of the ceiling back on every success.
+    _DECREASE_FACTOR = 0.5
+    _DECREASE_COOLDOWN = 1.0
+    _INCREASE_FRACTION = 0.01
+    _MIN_RATE_FRACTION = 0.05
+    _LOGGER = logging.getLogger(__name__)
+
+
+    def __init__(self, rate, burst, adaptive=True):
+        self._max_rate = rate
+        self._min_rate = rate * RateLimiter._MIN_RATE_FRACTION
+        self._rate = rate
+        self._burst = max(burst, 1)
+        self._adaptive = adaptive
+        self._tokens = self._burst
+        self._updated_at = time.monotonic()
+        self._decreased_at = 0.0
+        self._lock = threading.Lock()
+
+
+    @property
+    def rate(self):
+        return self._rate
+
+
+    @property
+    def enabled(self):
+        return self._max_rate > 0
+
+
+    def _refill(self, now):
+        self._tokens = min(
+            self._burst,
+            self._tokens + (now - self._updated_at) * self._rate
+        )
+        self._updated_at = now
+
+
+    def reserve(self, tokens=1):
+        if not self.enabled:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            # Take the tokens right away and go into debt if needed, the
+            # caller then sleeps until the debt would have been paid off.
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self._rate
+
+
+    def acquire(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+
+    async def acquire_async(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+    def on_throttle(self):
+        if not (self.enabled and self._adaptive):
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now - self._decreased_at < RateLimiter._DECREASE_COOLDOWN:
+                return
+            self._refill(now)
+            self._decreased_at = now
+            self._rate = max(self._min_rate, self._rate * RateLimiter._DECREASE_FACTOR)
+        metrics.inc(metrics.THROTTLED_TOTAL)
+        metrics.get_registry().gauge(metrics.REQUEST_RATE).set(self._rate)
+        RateLimiter._LOGGER.warning(f'Throttled by server, request rate lowered to {self._rate:.2f}/s')
+
+
+    def on_success(self):
+        if not (self.enabled and self._adaptive) or self._rate >= self._max_rate:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self._rate = min(
+                self._max_rate,
+                self._rate + self._max_rate * RateLimiter._INCREASE_FRACTION
+            )
+        metrics.get_registry().gauge(metrics.REQUEST_RATE).set(self._rate)
+
+
+    def on_status(self, status_code):
+        if status_code in RateLimiter.THROTTLE_STATUS_CODES:
+            self.on_throttle()
+        elif status_code < 400:
+            self.on_success()
+
+
+_lock = threading.Lock()
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _lock:
+            if _rate_limiter is None:
+                _rate_limiter = RateLimiter(
+                    config.get('rate_limit'),
+                    config.get('rate_burst'),
+                )
+                metrics.get_registry().gauge(metrics.REQUEST_RATE).set(_rate_limiter.rate)
+    return _rate_limiter
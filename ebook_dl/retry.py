@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import time
+import random
+import asyncio
+import logging
+import threading
+import requests
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from . import config
+from . import metrics
+
+__all__ = [
+    'RetryError', 'RetryableError', 'CircuitOpenError',
+    'RetryPolicy', 'CircuitBreaker', 'get_policy', 'get_breaker',
+]
+
+
+class RetryError(Exception):
+    def __init__(self, url, attempts, last_error):
+        super().__init__(f'{url} failed after {attempts} attempt(s): {last_error}')
+        self.url = url
+        self.attempts = attempts
+        self.last_error = last_error
+
+
+class RetryableError(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, host, remaining, half_open=False):
+        if half_open:
+            super().__init__(f'Circuit for {host} is half-open, waiting {remaining:.1f}s for its probe')
+        else:
+            super().__init__(f'Circuit for {host} is open for another {remaining:.1f}s')
+        self.remaining = remaining
+        self.half_open = half_open
+
+
+class CircuitBreaker:
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    # Callers that lose the half-open probe wait about this long for it to
+    # report back, jittered so they do not all ask again at once.
+    _HALF_OPEN_WAIT = 1.0
+    _HALF_OPEN_JITTER = 0.5
+    _LOGGER = logging.getLogger(__name__)
+
+
+    def __init__(self, host, failure_threshold, reset_timeout):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = CircuitBreaker.CLOSED
+        self._failure_count = 0
+        self._opened_at = 0.0
+        self._last_error = None
+        self._lock = threading.Lock()
+
+
+    @property
+    def state(self):
+        return self._state
+
+
+    @property
+    def last_error(self):
+        return self._last_error
+
+
+    def before_call(self):
+        with self._lock:
+            if self._state == CircuitBreaker.CLOSED:
+                return
+            if self._state == CircuitBreaker.OPEN:
+                remaining = self._opened_at + self.reset_timeout - time.monotonic()
+                if remaining <= 0:
+                    # Let exactly one probe through, the others keep waiting
+                    # until it reports back.
+                    self._state = CircuitBreaker.HALF_OPEN
+                    return
+                raise CircuitOpenError(self.host, remaining)
+            jitter = CircuitBreaker._HALF_OPEN_JITTER
+            raise CircuitOpenError(
+                self.host, CircuitBreaker._HALF_OPEN_WAIT * random.uniform(1 - jitter, 1 + jitter), half_open=True
+            )
+
+
+    def record_success(self):
+        with self._lock:
+            self._state = CircuitBreaker.CLOSED
+            self._failure_count = 0
+
+
+    def record_failure(self, error=None):
+        with self._lock:
+            self._failure_count += 1
+            self._last_error = error
+            if self._state == CircuitBreaker.HALF_OPEN or \
+                    self._failure_count >= self.failure_threshold:
+                if self._state != CircuitBreaker.OPEN:
+                    CircuitBreaker._LOGGER.warning(f'Circuit for {self.host} opened')
+                    metrics.inc(metrics.CIRCUIT_OPEN_TOTAL)
+                self._state = CircuitBreaker.OPEN
+                self._opened_at = time.monotonic()
+
+
+class RetryPolicy:
+
+    RETRYABLE_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)
+    DEFAULT_RETRY_ON = (requests.RequestException, OSError, RetryableError)
+    _LOGGER = logging.getLogger(__name__)
+
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0, jitter=True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        if self.jitter:
+            # Full jitter keeps hundreds of workers from retrying in lockstep.
+            delay = random.uniform(0, delay)
+        return delay
+
+
+    @staticmethod
+    def _response_of(error):
+        response = getattr(error, 'response', None)
+        if response is not None:
+            return response.status_code, response.headers
+        status = getattr(error, 'status', None)
+        if status is not None:
+            return status, getattr(error, 'headers', None) or {}
+        return None, {}
+
+
+    @staticmethod
+    def retry_after(headers):
+        value = headers.get('Retry-After') if headers else None
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+    def _next_delay(self, error, attempt, retry_on):
+        if not isinstance(error, retry_on):
+            return None
+        status, headers = RetryPolicy._response_of(error)
+        if status is not None and status not in RetryPolicy.RETRYABLE_STATUS_CODES:
+            return None
+        delay = self.backoff(attempt)
+        retry_after = RetryPolicy.retry_after(headers)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+    @staticmethod
+    def _counts_against_host(error, retry_on):
+        # Only network and http errors, a local one says nothing of the host.
+        if not isinstance(error, retry_on):
+            return False
+        status, _ = RetryPolicy._response_of(error)
+        return status is None or status in RetryPolicy.RETRYABLE_STATUS_CODES
+
+
+    @staticmethod
+    def _on_circuit_open(url, breaker, error, attempt, last_error):
+        # Nothing was sent, so no attempt is used up. While the circuit is
+        # open the url fails right away, with the last error the host gave
+        # when there is one, and is claimed again by the next run. Only the
+        # wait for a half-open probe is short enough to sit out.
+        if not error.half_open:
+            raise RetryError(url, attempt, last_error or breaker.last_error or error) from error
+        return error.remaining
+
+
+    def _on_error(self, url, breaker, error, attempt, retry_on):
+        if RetryPolicy._counts_against_host(error, retry_on):
+            breaker.record_failure(error)
+        else:
+            # e.g. a 404, the host itself answered fine.
+            breaker.record_success()
+        delay = self._next_delay(error, attempt, retry_on)
+        if delay is None or attempt >= self.max_attempts:
+            raise RetryError(url, attempt, error) from error
+        metrics.inc(metrics.RETRIES_TOTAL)
+        RetryPolicy._LOGGER.warning(f'Attempt {attempt} for {url} failed: {error}, re-try in {delay:.1f}s')
+        return delay
+
+
+    def call(self, url, func, *args, retry_on=DEFAULT_RETRY_ON):
+        breaker = get_breaker(url)
+        attempt = 0
+        last_error = None
+        while True:
+            try:
+                breaker.before_call()
+            except CircuitOpenError as e:
+                time.sleep(RetryPolicy._on_circuit_open(url, breaker, e, attempt, last_error))
+                continue
+            attempt += 1
+            try:
+                result = func(url, *args)
+            except Exception as e:
+                last_error = e
+                time.sleep(self._on_error(url, breaker, e, attempt, retry_on))
+                continue
+            breaker.record_success()
+            return result
+
+
+    async def call_async(self, url, func, *args, retry_on=DEFAULT_RETRY_ON):
+        breaker = get_breaker(url)
+        attempt = 0
+        last_error = None
+        while True:
+            try:
+                breaker.before_call()
+            except CircuitOpenError as e:
+                await asyncio.sleep(RetryPolicy._on_circuit_open(url, breaker, e, attempt, last_error))
+                continue
+            attempt += 1
+            try:
+                result = await func(url, *args)
+            except Exception as e:
+                last_error = e
+                await asyncio.sleep(self._on_error(url, breaker, e, attempt, retry_on))
+                continue
+            breaker.record_success()
+            return result
+
+
+_lock = threading.Lock()
+_policy = None
+_breakers = {}
+
+
+def get_policy():
+    global _policy
+    if _policy is None:
+        with _lock:
+            if _policy is None:
+                _policy = RetryPolicy(
+                    max_attempts=config.get('max_attempts'),
+                    base_delay=config.get('backoff_base'),
+                    max_delay=config.get('backoff_max'),
+                )
+    return _policy
+
+
+def get_breaker(url):
+    host = urlparse(url).netloc
+    breaker = _breakers.get(host)
+    if breaker is None:
+        with _lock:
+            breaker = _breakers.setdefault(host, CircuitBreaker(
+                host,
+                config.get('breaker_threshold'),
+                config.get('breaker_reset'),
+            ))
+    return breaker
@@ -2,80 +2,130 @@
 # -*- conding:utf-8 -*-
 
 from . import config
+from . import dedup
+from . import download_target
+from . import parser
+from . import retry
+from . import metrics
+from . import session
+from . import http_cache
+from .retry import RetryError
+from .downloader import Downloader, DownloadScheduler, RichDownloadProgress
 from .thread_manager import ThreadManager
-from .db import Db
+from .db import Db, get_db
+from .ledger import get_ledger
 from .db import BookInfo
+from .db import BookUrl
+from .writer import DbWriter
 
 import os
-import re
+import itertools
 import typer
-import time
-import requests
 import logging
 import rich
-from urllib.parse import quote
+import rich.progress
+import rich.table
 from tomd import Tomd
-from bs4 import BeautifulSoup
 
 
 class Scraper:
 
     _MAIN_URL = 'https://itebooksfree.com/'
-    _URL_THAT_WONT_WORK = 'http://file.allitebooks.com'
     _REQUEST_TIMEOUT = 15
     _DEFAULT_OUTPUT_DIR = 'output'
+    _SEARCH_STAGE = Db.SEARCH_STAGE
+    _PROFILE_STAGE = Db.PROFILE_STAGE
+    _RESOURCE_URL_STAGE = Db.RESOURCE_URL_STAGE
+    _DOWNLOAD_STAGE = Db.DOWNLOAD_STAGE
     _LOGGER = logging.getLogger(__name__)
 
 
     def __init__(self):
         self._search_key = config.get('keyword')
-        self.db = Db()
+        self.db = get_db()
         self._book_profile_page_urls = []
-        self._book_info_collection = []
         self._book_url_collection = []
+        self._crawl_counts = {}
+        self._crawl_status = None
+
+
+    @staticmethod
+    def _main_url():
+        main_url = config.get('main_url') or Scraper._MAIN_URL
+        return main_url.rstrip('/') + '/'
 
 
     @staticmethod
     def _construct_search_api(search_key='', page=None):
         if search_key == '' and page is None:
-            return Scraper._MAIN_URL
+            return Scraper._main_url()
         elif search_key == '' and page:
-            return f'{Scraper._MAIN_URL}/page/{page}'
+            return f'{Scraper._main_url()}/page/{page}'
         elif page is None:
-            return f'{Scraper._MAIN_URL}/search/{search_key}'
+            return f'{Scraper._main_url()}/search/{search_key}'
         else:
-            return f'{Scraper._MAIN_URL}/search/{search_key}/{page}'
+            return f'{Scraper._main_url()}/search/{search_key}/{page}'
 
 
     @staticmethod
     def _get_page(url):
-        response = requests.get(
-            url, 
-            headers=config.get('fake_headers'),
-            timeout=Scraper._REQUEST_TIMEOUT,
-        )
-        response.raise_for_status()
+        cache = http_cache.get_cache()
+        page = cache.lookup(url) if cache else None
+        if page is not None and cache.is_fresh(page):
+            return page.text
+        with metrics.track('fetch_page'):
+            response = session.get(
+                url,
+                headers=http_cache.HttpCache.conditional_headers(page),
+                timeout=Scraper._REQUEST_TIMEOUT
+            )
+            metrics.inc(metrics.BYTES_TOTAL, len(response.content), operation='fetch_page')
+            if page is not None and response.status_code == 304:
+                cache.revalidated(url)
+                return page.text
+            response.raise_for_status()
+        if cache:
+            cache.store(url, response.text, response.headers)
         return response.text
 
 
     @staticmethod
-    def _get_bs_obj(url, retry_count):
-        try:
-            page_text = Scraper._get_page(url)
-            return BeautifulSoup(page_text, 'html.parser')
-        except Exception as e:
-            Scraper._LOGGER.warning(f'{Scraper._get_bs_obj.__name__} exception: {e} for url: {url}')
-            retry_count += 1
-            # Sleep 1s to avoid stack overflow when sudden Internet
-            # disconnection occurs.
-            time.sleep(1)
-            Scraper._LOGGER.warning(f'Re-try {Scraper._get_bs_obj.__name__} {retry_count} times')
-            return Scraper._get_bs_obj(url, retry_count)
+    def _get_json(url):
+        response = session.get(url, timeout=Scraper._REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
 
 
     @staticmethod
-    def _start_get_bs_obj(url):
-        return Scraper._get_bs_obj(url, 0)
+    def _fetch_page(url):
+        return retry.get_policy().call(url, Scraper._get_page)
+
+
+    @staticmethod
+    def _get_bs_obj(url, page_type=None):
+        return parser.make_soup(Scraper._fetch_page(url), page_type)
+
+
+    @staticmethod
+    def _store():
+        # Where the stages record failures, resolutions and content: the db,
+        # or for a worker of a coordinator its RemoteLedger.
+        return get_ledger() if config.get('coordinator') else get_db()
+
+
+    @staticmethod
+    def _record_failure(stage, key, error):
+        Scraper._LOGGER.error(f'Giving up {stage} for {key}: {error.last_error}')
+        Scraper._store().store_failure(stage, key, error.attempts, str(error.last_error))
+
+
+    @staticmethod
+    def _check_book_info(url, book_info):
+        if book_info:
+            book_info.profile_url = url
+        else:
+            Scraper._store().store_failure(Scraper._PROFILE_STAGE, url, 1, 'no book info on page')
+        return book_info
 
 
     @staticmethod
@@ -112,35 +162,28 @@ class Scraper:
         return urls
 
 
+    # The two _parse_* methods may run in a worker process, see parser.parse.
     @staticmethod
-    def _calculate_start_index_and_workload(index, url_workload, extra_workload):
-        if index < extra_workload:
-            workload = url_workload + 1
-            start_index = index * workload
-        else:
-            workload = url_workload
-            start_index = extra_workload * (workload + 1) + (index - extra_workload) * workload
-        return start_index, workload
+    def _parse_listing_page(page_text, backend):
+        page_bs = parser.make_soup(page_text, parser.LISTING_PAGE, backend)
+        return Scraper._retrieve_book_profile_page_urls_from_page(page_bs)
 
 
     @staticmethod
-    def _retrieve_profile_page_urls(page_index, search_key):
-        index_page_url = Scraper._construct_search_api(search_key, page_index)
-        page_bs = Scraper._start_get_bs_obj(index_page_url)
-        return Scraper._retrieve_book_profile_page_urls_from_page(page_bs)
+    def _parse_profile_page(page_text, backend):
+        book_bs = parser.make_soup(page_text, parser.PROFILE_PAGE, backend)
+        return Scraper._get_book_info_from_bs(book_bs)
 
 
     @staticmethod
-    def _run_profile_page_urls(thread_pools, index, url_workload, extra_workload, search_key):
-        thread_profile_page_urls = []
-        start_index, workload = Scraper._calculate_start_index_and_workload(
-            index, url_workload, extra_workload
-        )
-        start_index += 2
-        for i in range(start_index, start_index + workload):
-            thread_profile_page_urls += Scraper._retrieve_profile_page_urls(i, search_key)
-        thread_pools[index] = thread_profile_page_urls
-        config.get('console').log(f'Thread {index} finished its job.')
+    def _retrieve_profile_page_urls(page_index, search_key):
+        index_page_url = Scraper._construct_search_api(search_key, page_index)
+        try:
+            page_text = Scraper._fetch_page(index_page_url)
+        except RetryError as e:
+            Scraper._record_failure(Scraper._SEARCH_STAGE, index_page_url, e)
+            return None
+        return parser.parse(Scraper._parse_listing_page, page_text)
 
 
     @staticmethod
@@ -165,209 +208,360 @@ class Scraper:
             bookInfo.description = Tomd(str(description_bs)).markdown.strip()
         download_bs = content_bs.find('span', {'class': 'tn-download'})
         if download_bs:
-            bookInfo.tn_url.append(download_bs.get('tn-url'))
+            bookInfo.tn_url = download_bs.get('tn-url') or ''
         return bookInfo
 
 
     @staticmethod
     def _get_resource_url_from_tn_url(tn_url):
-        url = Scraper._MAIN_URL + '/download/' + tn_url
+        resource_url = Scraper._store().lookup_resolution(tn_url)
+        if resource_url:
+            return resource_url
+        url = Scraper._main_url() + '/download/' + tn_url
         try:
-            response = requests.get(
-                url, 
-                headers=config.get('fake_headers'),
-                timeout=Scraper._REQUEST_TIMEOUT,
-            )
-            response.raise_for_status()
-            res_json = response.json()
-            if res_json['ok']:
-                return res_json['url']
-            return ''
-        except Exception as e:
-            Scraper._LOGGER.error(f'Get resource url failed: {e}')
+            with metrics.track('resolve'):
+                res_json = retry.get_policy().call(url, Scraper._get_json)
+        except RetryError as e:
+            Scraper._record_failure(Scraper._RESOURCE_URL_STAGE, tn_url, e)
             return ''
+        if res_json.get('ok'):
+            return res_json['url']
+        return ''
 
 
     @staticmethod
-    def _run_collect_book_info(thread_pools, index, url_workload, extra_workload, profile_urls):
-        thread_book_info_collection = []
-        start_index, workload = Scraper._calculate_start_index_and_workload(
-            index, url_workload, extra_workload
-        )
-        for url in profile_urls[start_index:start_index+workload]:
-            book_bs = Scraper._start_get_bs_obj(Scraper._MAIN_URL + url)
-            book_info = Scraper._get_book_info_from_bs(book_bs)
-            thread_book_info_collection.append(book_info)
-        thread_pools[index] = thread_book_info_collection
-        config.get('console').log(f'Thread {index} finished its job.')
+    def _run_collect_book_info(url):
+        try:
+            page_text = Scraper._fetch_page(Scraper._main_url() + url)
+        except RetryError as e:
+            Scraper._record_failure(Scraper._PROFILE_STAGE, url, e)
+            return None
+        book_info = parser.parse(Scraper._parse_profile_page, page_text)
+        return Scraper._check_book_info(url, book_info)
 
 
     @staticmethod
-    def _run_collect_book_url(thread_pools, index, url_workload, extra_workload, book_urls):
-        thread_book_url_collection = []
-        start_index, workload = Scraper._calculate_start_index_and_workload(
-            index, url_workload, extra_workload
-        )
-        for book_url in book_urls[start_index:start_index+workload]:
+    def _set_download_target(book_url):
+        target = download_target.parse(book_url.resource_url, Scraper._main_url(), Scraper._DEFAULT_OUTPUT_DIR)
+        if target is not None:
+            book_url.download_url, book_url.file_path, book_url.date_code = target
+
+
+    @staticmethod
+    def _resolved(book_url):
+        return bool(book_url.resource_url)
+
+
+    @staticmethod
+    def _run_collect_book_url(book_url):
+        if not book_url.resource_url:
             book_url.resource_url = Scraper._get_resource_url_from_tn_url(book_url.tn_url)
-            thread_book_url_collection.append(book_url)
-        thread_pools[index] = thread_book_url_collection
-        config.get('console').log(f'Thread {index} finished its job.')
+        Scraper._set_download_target(book_url)
+        return book_url
 
 
     @staticmethod
-    def _run_download_all(index, url_workload, extra_workload, book_urls):
-        start_index, workload = Scraper._calculate_start_index_and_workload(
-            index, url_workload, extra_workload
-        )
-        for book_url in book_urls[start_index:start_index+workload]:
-            if book_url.resource_url.startswith(Scraper._URL_THAT_WONT_WORK):
-                continue
-            if book_url.resource_url.startswith('/'):
-                resource_url = Scraper._MAIN_URL + book_url.resource_url[1:]
-                filename_regex = re.compile('^.+/(.+)$')
-                date_code_regex = re.compile('^.+/(.+)/.*$')
-                date_code_2_regex = re.compile('^.+/(.*)//.*$')
-                prefix_regex = re.compile('^(.+)/.*$')
-                filename = filename_regex.findall(resource_url)[0]
-                date_code = date_code_regex.findall(resource_url)[0]
-                if date_code == '':
-                    date_code = date_code_2_regex.findall(resource_url)[0]
-                quoted_resource_url = ''.join([
-                    prefix_regex.findall(resource_url)[0],
-                    '/',
-                    quote(filename)
-                ])
-                file_path = ''.join([
-                    Scraper._DEFAULT_OUTPUT_DIR,
-                    '/',
-                    '"',
-                    date_code,
-                    ' ',
-                    filename,
-                    '"',
-                ])
-                Scraper._download_from_url_and_save(quoted_resource_url, file_path, filename)
-        config.get('console').log(f'Thread {index} finished its job.')
+    def _download_jobs(book_urls):
+        # The target is worked out when the tn_url is resolved and stored
+        # with it, only rows resolved before that was done get it here.
+        for book_url in book_urls:
+            if not book_url.download_url and book_url.resource_url:
+                Scraper._set_download_target(book_url)
+            if book_url.download_url:
+                yield book_url.download_url, book_url.file_path, book_url
 
 
     @staticmethod
-    def _download_from_url_and_save(url, path, filename):
-        download_command = 'axel %s --output=%s' % (url, path)
-        result = os.system('xterm -e %s' % download_command)
-        if result == 0:
+    def _on_download_failure(book_url, error):
+        Scraper._record_failure(Scraper._DOWNLOAD_STAGE, book_url.resource_url, error)
+
+
+    @staticmethod
+    def _on_download_complete(download):
+        if download.sha256 is None:
             return
-        rich.print(f'Download {filename} failed, now re-start its downloading...')
-        Scraper.__download_from_url_and_save(url, path, filename)
+        store = Scraper._store()
+        original_path = store.store_content(download.size, download.sha256, download.path)
+        if original_path != download.path and \
+                not dedup.link_duplicate(download.path, original_path, download.size, download.sha256):
+            store.replace_content_path(download.size, download.sha256, download.path)
 
 
-    def _retrieve_book_profile_page_urls_from_other_page(self, page_count):
+    def _retrieve_book_profile_page_urls_from_other_page(self, page_count, writer):
         thread_manager = ThreadManager()
-        thread_manager.thread_job_distribution(page_count, ThreadManager.THREAD_PROFILE_PAGE_JOB)
+        thread_manager.thread_job_distribution(
+            range(2, page_count + 1),
+            ThreadManager.THREAD_PROFILE_PAGE_JOB
+        )
         thread_manager.thread_job_preparation(
-            Scraper._run_profile_page_urls,
+            Scraper._retrieve_profile_page_urls,
             ThreadManager.THREAD_PROFILE_PAGE_JOB,
             self._search_key
         )
-        thread_manager.thread_job_handling(self._book_profile_page_urls)
-
-
-    def get_all_book_profile_page_urls(self):
+        for urls in thread_manager.thread_job_results():
+            self._book_profile_page_urls += urls
+            writer.put_profile_urls(urls)
+
+
+    def _retrieve_new_book_profile_page_urls(self, first_page_urls, page_count):
+        # Listings are ordered newest first, so the walk ends at the first
+        # page that holds nothing but urls listed by an earlier run.
+        known_urls = set(self.db.select_all_profile_urls())
+        urls = first_page_urls
+        page_index = 1
+        while True:
+            new_urls = [url for url in urls if url not in known_urls]
+            if urls and not new_urls:
+                Scraper._LOGGER.info(f'Page {page_index} is already known, stopping the search')
+                break
+            known_urls.update(new_urls)
+            yield new_urls
+            page_index += 1
+            if page_index > page_count:
+                break
+            urls = Scraper._retrieve_profile_page_urls(page_index, self._search_key) or []
+
+
+    def get_all_book_profile_page_urls(self, incremental=False):
         search_api = Scraper._construct_search_api(self._search_key)
-        main_bs = Scraper._start_get_bs_obj(search_api)
+        try:
+            main_bs = Scraper._get_bs_obj(search_api, parser.LISTING_PAGE)
+        except RetryError as e:
+            Scraper._record_failure(Scraper._SEARCH_STAGE, search_api, e)
+            rich.print(f'Failed to load [bold]{search_api}[/bold], please try again later.')
+            return
         page_count = Scraper._get_pagination_count(main_bs)
         styled_page_count = typer.style(str(page_count), fg=typer.colors.MAGENTA, bold=True)
         typer.echo(f'There are {styled_page_count} page(s) in total.')
-        with config.get('console').status('[bold green]retrieving book profile page urls...') as status:
-            self._book_profile_page_urls = Scraper._retrieve_book_profile_page_urls_from_page(main_bs)
-            if page_count > 1:
-                self._retrieve_book_profile_page_urls_from_other_page(page_count - 1)
+        with config.get('console').status('[bold green]retrieving book profile page urls...') as status, \
+                DbWriter() as writer:
+            first_page_urls = Scraper._retrieve_book_profile_page_urls_from_page(main_bs)
+            if incremental:
+                for urls in self._retrieve_new_book_profile_page_urls(first_page_urls, page_count):
+                    self._book_profile_page_urls += urls
+                    writer.put_profile_urls(urls)
+            else:
+                self._book_profile_page_urls = first_page_urls
+                writer.put_profile_urls(self._book_profile_page_urls)
+                if page_count > 1:
+                    self._retrieve_book_profile_page_urls_from_other_page(page_count, writer)
         styled_book_count = typer.style(str(len(self._book_profile_page_urls)), fg=typer.colors.MAGENTA, bold=True)
-        typer.echo(f'There are {styled_book_count} book urls in total.')
-        self.db.store_profile_page_urls(self._book_profile_page_urls)
+        if incremental:
+            typer.echo(f'There are {styled_book_count} new book urls.')
+        else:
+            typer.echo(f'There are {styled_book_count} book urls in total.')
         typer.echo('Done.')
 
 
-    def _profile_urls_status(self):
-        filename_pattern = re.compile('^/book/(.*)/[0-9]*$')
-        unique_book_names = []
-        for url in self._book_profile_page_urls:
-            match = re.fullmatch(filename_pattern, url)
-            if match:
-                unique_book_names.append(match.group(1))
+    def _profile_urls_status(self, status):
         table = rich.table.Table(show_header=True, header_style='magenta')
         table.add_column('Item', style='dim')
         table.add_column('Count', width=12)
-        table.add_row('Profile url count', str(len(self._book_profile_page_urls)))
-        table.add_row('Unique book names from urls', str(len(set(unique_book_names))))
+        table.add_row('Profile url count', str(self.db.count_profile_urls(status)))
+        table.add_row('Unique book names from urls', str(self.db.count_profile_book_names(status)))
+        table.add_row('Duplicate urls skipped', str(self.db.count_profile_urls(Db.STATUS_DUPLICATE)))
         config.get('console').print(table)
         rich.print()
 
 
     def _collect_book_info_from_profile_pages(self):
         thread_manager = ThreadManager()
-        thread_manager.thread_job_distribution(len(self._book_profile_page_urls), ThreadManager.THREAD_RETRIEVE_RESOURCE_JOB)
+        thread_manager.thread_job_distribution(
+            self._book_profile_page_urls,
+            ThreadManager.THREAD_RETRIEVE_RESOURCE_JOB
+        )
         thread_manager.thread_job_preparation(
             Scraper._run_collect_book_info,
-            ThreadManager.THREAD_RETRIEVE_RESOURCE_JOB,
-            self._book_profile_page_urls
+            ThreadManager.THREAD_RETRIEVE_RESOURCE_JOB
         )
-        self._book_info_collection = []
-        thread_manager.thread_job_handling(self._book_info_collection)
-        self._book_info_collection = list(
-            filter(lambda x: x is not None, self._book_info_collection)
-        )
-        self.db.store_book_info_collection(self._book_info_collection)
+        with DbWriter() as writer:
+            for book_info in thread_manager.thread_job_results():
+                writer.put_book_info(book_info)
 
 
     def _collect_resource_urls_from_tn_urls(self):
         thread_manager = ThreadManager()
-        thread_manager.thread_job_distribution(len(self._book_url_collection), ThreadManager.THREAD_COLLECT_RESOURCE_URL_JOB)
+        thread_manager.thread_job_distribution(
+            self._book_url_collection,
+            ThreadManager.THREAD_COLLECT_RESOURCE_URL_JOB
+        )
         thread_manager.thread_job_preparation(
             Scraper._run_collect_book_url,
             ThreadManager.THREAD_COLLECT_RESOURCE_URL_JOB,
-            self._book_url_collection
+            succeeded=Scraper._resolved
         )
         self._book_url_collection = []
-        thread_manager.thread_job_handling(self._book_url_collection)
-        self.db.store_book_url_collection(self._book_url_collection)
+        with DbWriter() as writer:
+            for book_url in thread_manager.thread_job_results():
+                writer.put_book_url(book_url)
 
 
-    def _download_all_books(self):
+    def _download_all_books(self, progress):
         if not os.path.exists(self._DEFAULT_OUTPUT_DIR):
             os.mkdir(self._DEFAULT_OUTPUT_DIR, 0o775)
-        thread_manager = ThreadManager()
-        thread_manager.thread_job_distribution(len(self._book_url_collection), ThreadManager.THREAD_DOWNLOAD_JOB)
-        thread_manager.thread_job_preparation(
-            Scraper._run_download_all,
-            ThreadManager.THREAD_DOWNLOAD_JOB,
-            self._book_url_collection
+        scheduler = DownloadScheduler(
+            Downloader(progress=RichDownloadProgress(progress)),
+            on_failure=Scraper._on_download_failure,
+            on_complete=Scraper._on_download_complete
         )
-        thread_manager.thread_job_handling()
+        with DbWriter() as writer:
+            for book_url in scheduler.results(Scraper._download_jobs(self._book_url_collection)):
+                writer.put_downloaded(book_url)
 
 
-    def collect_book_info(self):
-        self._book_profile_page_urls = self.db.select_all_profile_urls()
-        self._profile_urls_status()
-        if self._book_profile_page_urls == []:
+    def collect_book_info(self, retry_failed=False):
+        claimed_count = self.db.claim_profile_urls(failed_only=retry_failed)
+        self._profile_urls_status(Db.STATUS_IN_FLIGHT)
+        if claimed_count == 0 and (retry_failed or self.db.count_profile_urls()):
+            rich.print(':monkey: :pile_of_poo: It looks like nothing needs to be done.')
+            return
+        if claimed_count == 0:
             rich.print('There is no record in [bold]profile[/bold] table, probably need to run [bold]search[/bold] command first.')
             rich.print(':monkey: :pile_of_poo:')
             return
+        # Streamed from the db batch by batch, the first pages are fetched
+        # while the later rows are not read yet.
+        self._book_profile_page_urls = self.db.select_all_profile_urls(status=Db.STATUS_IN_FLIGHT)
         with config.get('console').status('[bold green]collecting book info from profile pages...') as status:
             self._collect_book_info_from_profile_pages()
     
 
     def collect_all_resource_urls(self):
-        self._book_url_collection = self.db.select_all_book_urls()
-        if self._book_url_collection == []:
+        claimed_count = self.db.claim_book_urls()
+        backing_off_count = self.db.count_backing_off_book_urls()
+        if backing_off_count:
+            styled_count = typer.style(str(backing_off_count), fg=typer.colors.MAGENTA, bold=True)
+            typer.echo(f'Skipping {styled_count} tn_url(s) that failed recently, see --resolve-backoff.')
+        if claimed_count == 0:
             rich.print(':monkey: :pile_of_poo: It looks like nothing needs to be done.')
+            return
+        self._book_url_collection = self.db.select_all_book_urls()
         with config.get('console').status('[bold green]collecting resource urls from tn_urls...') as status:
             self._collect_resource_urls_from_tn_urls()
 
 
+    @staticmethod
+    def _start_stage(work_items, thread_job, thread_func, *thread_func_args, succeeded=None):
+        thread_manager = ThreadManager()
+        thread_manager.thread_job_distribution(work_items, thread_job)
+        thread_manager.thread_job_preparation(thread_func, thread_job, *thread_func_args, succeeded=succeeded)
+        return thread_manager.thread_job_results()
+
+
+    def _count_crawled(self, stage):
+        self._crawl_counts[stage] += 1
+        self._crawl_status.update('[bold green]crawling... ' + ', '.join(
+            f'{name}: {count}' for name, count in self._crawl_counts.items()
+        ))
+
+
+    def _stream_profile_urls(self, url_lists, writer):
+        # Profile pages finished by an earlier crawl are not fetched again,
+        # nor other profile pages of a book name already seen.
+        seen_urls = set(self.db.select_all_profile_urls(status=Db.STATUS_DONE))
+        seen_names = {dedup.book_name(url) for url in seen_urls} if self.db.dedup else set()
+        for urls in url_lists:
+            writer.put_profile_urls(urls)
+            for url in urls:
+                self._count_crawled('listed')
+                if url in seen_urls:
+                    continue
+                seen_urls.add(url)
+                name = dedup.book_name(url) if self.db.dedup else ''
+                if name in seen_names:
+                    metrics.inc(metrics.DUPLICATES_TOTAL, kind='profile')
+                    continue
+                if name:
+                    seen_names.add(name)
+                yield url
+
+
+    def _stream_book_urls(self, book_infos, writer):
+        for book_info in book_infos:
+            self._count_crawled('profiles')
+            writer.put_book_info(book_info)
+            if book_info.tn_url:
+                yield BookUrl(tn_url=book_info.tn_url)
+
+
+    def _stream_resource_urls(self, book_urls, writer):
+        # Failures are written too, so that they back off like in the
+        # resource-url stage.
+        for book_url in book_urls:
+            writer.put_book_url(book_url)
+            if not book_url.resource_url:
+                continue
+            self._count_crawled('resolved')
+            yield book_url
+
+
+    def crawl(self, incremental=False):
+        search_api = Scraper._construct_search_api(self._search_key)
+        try:
+            main_bs = Scraper._get_bs_obj(search_api, parser.LISTING_PAGE)
+        except RetryError as e:
+            Scraper._record_failure(Scraper._SEARCH_STAGE, search_api, e)
+            rich.print(f'Failed to load [bold]{search_api}[/bold], please try again later.')
+            return
+        page_count = Scraper._get_pagination_count(main_bs)
+        styled_page_count = typer.style(str(page_count), fg=typer.colors.MAGENTA, bold=True)
+        typer.echo(f'There are {styled_page_count} page(s) in total.')
+        if not os.path.exists(self._DEFAULT_OUTPUT_DIR):
+            os.mkdir(self._DEFAULT_OUTPUT_DIR, 0o775)
+        self._crawl_counts = dict.fromkeys(('listed', 'profiles', 'resolved', 'downloaded'), 0)
+        with config.get('console').status('[bold green]crawling...') as status, \
+                DbWriter() as writer:
+            self._crawl_status = status
+            # Every stage pulls from the previous one through bounded queues,
+            # so a book can be downloading while later pages are still listed.
+            first_page_urls = Scraper._retrieve_book_profile_page_urls_from_page(main_bs)
+            if incremental:
+                url_lists = self._retrieve_new_book_profile_page_urls(first_page_urls, page_count)
+            else:
+                url_lists = itertools.chain(
+                    [first_page_urls],
+                    Scraper._start_stage(
+                        range(2, page_count + 1),
+                        ThreadManager.THREAD_PROFILE_PAGE_JOB,
+                        Scraper._retrieve_profile_page_urls,
+                        self._search_key
+                    )
+                )
+            book_infos = Scraper._start_stage(
+                self._stream_profile_urls(url_lists, writer),
+                ThreadManager.THREAD_RETRIEVE_RESOURCE_JOB,
+                Scraper._run_collect_book_info
+            )
+            book_urls = Scraper._start_stage(
+                self._stream_book_urls(book_infos, writer),
+                ThreadManager.THREAD_COLLECT_RESOURCE_URL_JOB,
+                Scraper._run_collect_book_url,
+                succeeded=Scraper._resolved
+            )
+            downloaded_book_urls = DownloadScheduler(
+                on_failure=Scraper._on_download_failure,
+                on_complete=Scraper._on_download_complete
+            ).results(Scraper._download_jobs(self._stream_resource_urls(book_urls, writer)))
+            for book_url in downloaded_book_urls:
+                self._count_crawled('downloaded')
+                writer.put_downloaded(book_url)
+        for name, count in self._crawl_counts.items():
+            styled_count = typer.style(str(count), fg=typer.colors.MAGENTA, bold=True)
+            typer.echo(f'{name.capitalize()}: {styled_count}')
+        typer.echo('Done.')
+
+
     def download_all_books(self):
-        self._book_url_collection = self.db.select_all_book_urls(use_resource_url=True)
-        if self._book_url_collection == []:
+        if self.db.claim_book_urls(use_resource_url=True) == 0:
             rich.print(':monkey: :pile_of_poo: It looks like nothing needs to be done.')
-        with config.get('console').status('[bold green]downloading all ebooks...') as status:
-            self._download_all_books()
\ No newline at end of file
+            return
+        self._book_url_collection = self.db.select_all_book_urls(use_resource_url=True)
+        with rich.progress.Progress(
+            rich.progress.TextColumn('[bold green]{task.description}', justify='right'),
+            rich.progress.BarColumn(),
+            rich.progress.DownloadColumn(),
+            rich.progress.TransferSpeedColumn(),
+            rich.progress.TimeRemainingColumn(),
+            console=config.get('console'),
+        ) as progress:
+            self._download_all_books(progress)
\ No newline at end of file
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_ACCEPT_ENCODING
+from . import config
+from .rate_limiter import get_rate_limiter
+
+__all__ = ['get', 'get_session', 'close']
+
+_lock = threading.Lock()
+_session = None
+
+
+def _create_session():
+    # pool_maxsize is the connection cap per host, and pool_block makes the
+    # surplus worker threads wait for a free keep-alive connection instead of
+    # opening (and later throwing away) extra ones.
+    adapter = HTTPAdapter(
+        pool_connections=config.get('pool_hosts'),
+        pool_maxsize=config.get('pool_maxsize'),
+        pool_block=True,
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(config.get('fake_headers'))
+    # Includes br (and zstd) when urllib3 is able to decode them.
+    session.headers['Accept-Encoding'] = DEFAULT_ACCEPT_ENCODING
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+def get(url, **kwargs):
+    rate_limiter = get_rate_limiter()
+    rate_limiter.acquire()
+    response = get_session().get(url, **kwargs)
+    rate_limiter.on_status(response.status_code)
+    return response
+
+
+def close():
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
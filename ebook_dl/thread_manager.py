@@ -1,7 +1,12 @@
 #!/usr/bin/python3
 # -*- coding:utf-8 -*-
 
+import time
+import queue
+import logging
 import threading
+from . import config
+from .concurrency import get_controller
 
 class ThreadManager():
 
@@ -10,72 +15,129 @@ class ThreadManager():
     THREAD_COLLECT_RESOURCE_URL_JOB = 3
     THREAD_DOWNLOAD_JOB = 4
 
-    THREAD_NUMBERS = {
+    # As many threads are started, and the ConcurrencyController of the
+    # stage lets as many of them work at once as the site copes with.
+    # --max-concurrency replaces these ceilings. The download threads only
+    # probe the files, the transfers have a controller of their own, see
+    # DownloadScheduler.
+    THREAD_CEILINGS = {
         THREAD_PROFILE_PAGE_JOB: 200,
         THREAD_RETRIEVE_RESOURCE_JOB: 130,
         THREAD_COLLECT_RESOURCE_URL_JOB: 130,
         THREAD_DOWNLOAD_JOB: 100,
     }
+    THREAD_STAGES = {
+        THREAD_PROFILE_PAGE_JOB: 'listing',
+        THREAD_RETRIEVE_RESOURCE_JOB: 'profile',
+        THREAD_COLLECT_RESOURCE_URL_JOB: 'resolve',
+        THREAD_DOWNLOAD_JOB: 'probe',
+    }
+
+    # Both queues are bounded so that a fast producer (or a slow result
+    # consumer) never makes the work items pile up in memory.
+    _QUEUE_SLOTS_PER_THREAD = 2
+    _STOP = object()
+    _LOGGER = logging.getLogger(__name__)
 
 
     def __init__(self):
         self._thread_count = 0
         self._thread_list = []
-        self._thread_pools = []
-
-        self._url_workload = 0
-        self._extra_url_worload = 0
-
-
-    def _thread_func_args(self, i, thread_job, param_payload):
-        if thread_job in (
-            ThreadManager.THREAD_PROFILE_PAGE_JOB,
-            ThreadManager.THREAD_RETRIEVE_RESOURCE_JOB,
-            ThreadManager.THREAD_COLLECT_RESOURCE_URL_JOB):
-            return (
-                self._thread_pools,
-                i,
-                self._url_workload,
-                self._extra_url_workload,
-                param_payload
-            )
-        elif thread_job == ThreadManager.THREAD_DOWNLOAD_JOB:
-            return (
-                i, self._url_workload, self._extra_url_workload, param_payload
-            )
-        else:
-            raise KeyError("Thread job doesn't exist")
+        self._work_items = ()
+        self._job_queue = None
+        self._result_queue = None
+        self._thread_func = None
+        self._thread_func_args = ()
+        self._succeeded = None
+        self._controller = None
+
 
+    @staticmethod
+    def controller(thread_job, ceiling=None):
+        ceiling = ceiling or config.get('max_concurrency') or ThreadManager.THREAD_CEILINGS[thread_job]
+        return get_controller(ThreadManager.THREAD_STAGES[thread_job], ceiling)
 
-    def thread_job_distribution(self, workload_url_count, thread_job):
-        thread_number = ThreadManager.THREAD_NUMBERS[thread_job]
-        if workload_url_count < thread_number:
-            self._thread_count = workload_url_count
-        else:
-            self._thread_count = thread_number
-        self._thread_pools = [[]] * self._thread_count
-        self._url_workload = workload_url_count // self._thread_count
-        self._extra_url_workload = workload_url_count % self._thread_count
+
+    def thread_job_distribution(self, work_items, thread_job):
+        if thread_job not in ThreadManager.THREAD_CEILINGS:
+            raise KeyError("Thread job doesn't exist")
+        self._controller = ThreadManager.controller(thread_job)
+        thread_number = self._controller.ceiling
+        try:
+            workload_count = len(work_items)
+        except TypeError:
+            # A generator, e.g. rows streamed from the db, size is unknown.
+            workload_count = thread_number
+        self._thread_count = min(workload_count, thread_number)
+        self._work_items = work_items
+        queue_size = max(self._thread_count, 1) * ThreadManager._QUEUE_SLOTS_PER_THREAD
+        self._job_queue = queue.Queue(maxsize=queue_size)
+        self._result_queue = queue.Queue(maxsize=queue_size)
 
 
-    def thread_job_preparation(self, thread_func, thread_job, param_payload):
+    # A job failed when it returned None, or when succeeded says so of the
+    # result it returned, e.g. a book_url whose tn_url did not resolve.
+    def thread_job_preparation(self, thread_func, thread_job, *thread_func_args, succeeded=None):
+        if thread_job not in ThreadManager.THREAD_CEILINGS:
+            raise KeyError("Thread job doesn't exist")
+        self._thread_func = thread_func
+        self._thread_func_args = thread_func_args
+        self._succeeded = succeeded
         for i in range(self._thread_count):
-            thread = threading.Thread(
-                target=thread_func,
-                args=self._thread_func_args(
-                    i, thread_job, param_payload
-                )
-            )
+            thread = threading.Thread(target=self._worker, args=(i,))
+            thread.daemon = True
             self._thread_list.append(thread)
 
 
-    def thread_job_handling(self, result_collector=None):
+    def _feeder(self):
+        try:
+            for item in self._work_items:
+                self._job_queue.put(item)
+        except Exception as e:
+            ThreadManager._LOGGER.error(f'Feeding work items failed: {e}')
+        finally:
+            for _ in range(self._thread_count):
+                self._job_queue.put(ThreadManager._STOP)
+
+
+    def _worker(self, index):
+        while True:
+            item = self._job_queue.get()
+            if item is ThreadManager._STOP:
+                break
+            self._controller.acquire()
+            started_at = time.perf_counter()
+            result = None
+            try:
+                result = self._thread_func(item, *self._thread_func_args)
+            except Exception as e:
+                ThreadManager._LOGGER.error(f'Thread {index} job failed: {e}')
+            finally:
+                self._controller.release(
+                    time.perf_counter() - started_at,
+                    result is not None and (self._succeeded is None or self._succeeded(result))
+                )
+            if result is not None:
+                self._result_queue.put(result)
+        self._result_queue.put(ThreadManager._STOP)
+        config.get('console').log(f'Thread {index} finished its job.')
+
+
+    def thread_job_results(self):
+        if self._thread_count == 0:
+            return
+        feeder = threading.Thread(target=self._feeder)
+        feeder.daemon = True
+        feeder.start()
         for thread in self._thread_list:
-            thread.setDaemon(True)
             thread.start()
+        finished_count = 0
+        while finished_count < self._thread_count:
+            result = self._result_queue.get()
+            if result is ThreadManager._STOP:
+                finished_count += 1
+                continue
+            yield result
         for thread in self._thread_list:
             thread.join()
-        if result_collector is None:
-            return
-        for pool in self._thread_pools:
-            result_collector += pool
+        feeder.join()
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import os
+import time
+import typer
+import logging
+import threading
+from . import config
+from .db import Db
+from .ledger import lease_key
+from .scraper import Scraper
+from .downloader import DownloadScheduler
+from .thread_manager import ThreadManager
+
+__all__ = ['Worker']
+
+
+class Worker:
+
+    # How often the leases are renewed, well within the lease ttl.
+    _HEARTBEAT_FRACTION = 1 / 3
+    _IDLE_INTERVAL = 2.0
+    # Later stages go first, so that a book claimed for its profile page is
+    # taken through the other stages before more profile pages are claimed.
+    _STAGES = (Db.DOWNLOAD_STAGE, Db.RESOURCE_URL_STAGE, Db.PROFILE_STAGE)
+    _LOGGER = logging.getLogger(__name__)
+
+
+    def __init__(self, ledger, worker_id, batch_size):
+        self._ledger = ledger
+        self._id = worker_id
+        self._batch_size = batch_size
+        self._counts = dict.fromkeys(Worker._STAGES, 0)
+        self._stop_event = threading.Event()
+
+
+    def _heartbeat(self):
+        interval = config.get('lease_ttl') * Worker._HEARTBEAT_FRACTION
+        while not self._stop_event.wait(interval):
+            try:
+                self._ledger.heartbeat(self._id)
+            except Exception as e:
+                Worker._LOGGER.warning(f'Heartbeat of {self._id} failed: {e}')
+
+
+    def _claim(self):
+        for stage in Worker._STAGES:
+            items = self._ledger.claim(stage, self._id, self._batch_size)
+            if items:
+                return stage, items
+        return None, []
+
+
+    @staticmethod
+    def _process(stage, items):
+        if stage == Db.PROFILE_STAGE:
+            return Scraper._start_stage(
+                items, ThreadManager.THREAD_RETRIEVE_RESOURCE_JOB, Scraper._run_collect_book_info
+            )
+        if stage == Db.RESOURCE_URL_STAGE:
+            return Scraper._start_stage(
+                items, ThreadManager.THREAD_COLLECT_RESOURCE_URL_JOB, Scraper._run_collect_book_url,
+                succeeded=Scraper._resolved
+            )
+        return DownloadScheduler(
+            on_failure=Scraper._on_download_failure,
+            on_complete=Scraper._on_download_complete
+        ).results(Scraper._download_jobs(items))
+
+
+    def _status_text(self):
+        return f'[bold green]worker {self._id}... ' + ', '.join(
+            f'{stage}: {count}' for stage, count in self._counts.items()
+        )
+
+
+    def run(self):
+        if not os.path.exists(Scraper._DEFAULT_OUTPUT_DIR):
+            os.makedirs(Scraper._DEFAULT_OUTPUT_DIR, 0o775, exist_ok=True)
+        heartbeat = threading.Thread(target=self._heartbeat)
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            with config.get('console').status(self._status_text()) as status:
+                # Done once nothing is left to claim and no other worker holds
+                # leases, whose results could still bring new rows.
+                while True:
+                    stage, items = self._claim()
+                    if stage is None:
+                        if not self._ledger.status()['leases']:
+                            break
+                        time.sleep(Worker._IDLE_INTERVAL)
+                        continue
+                    results = list(Worker._process(stage, items))
+                    self._ledger.complete(stage, self._id, (lease_key(stage, item) for item in items), results)
+                    self._counts[stage] += len(results)
+                    status.update(self._status_text())
+        finally:
+            self._stop_event.set()
+            heartbeat.join()
+            self._ledger.leave(self._id)
+        for stage, count in self._counts.items():
+            styled_count = typer.style(str(count), fg=typer.colors.MAGENTA, bold=True)
+            typer.echo(f'{stage}: {styled_count}')
+        typer.echo('Done.')
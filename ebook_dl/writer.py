@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+
+import time
+import queue
+import logging
+import threading
+from . import config
+from . import metrics
+from .db import Db, get_db
+
+__all__ = ['DbWriter']
+
+
+class DbWriter:
+
+    PROFILE_URL = 'profile_url'
+    BOOK_INFO = 'book_info'
+    BOOK_URL = 'book_url'
+    DOWNLOADED = 'downloaded'
+
+    # The stage failing for an item that could not be written, and the key
+    # it is recorded under in the failure table.
+    _FAILURE_KEYS = {
+        PROFILE_URL: (Db.SEARCH_STAGE, lambda url: url),
+        BOOK_INFO: (Db.PROFILE_STAGE, lambda book_info: book_info.profile_url),
+        BOOK_URL: (Db.RESOURCE_URL_STAGE, lambda book_url: book_url.tn_url),
+        DOWNLOADED: (Db.DOWNLOAD_STAGE, lambda book_url: book_url.resource_url),
+    }
+    _FLUSH_ATTEMPTS = 3
+    _FLUSH_RETRY_DELAY = 0.5
+    _STOP = object()
+    _LOGGER = logging.getLogger(__name__)
+
+
+    def __init__(self, batch_size=None, flush_interval=None):
+        self._batch_size = batch_size or config.get('write_batch_size')
+        self._flush_interval = flush_interval or config.get('write_interval')
+        self._queue = queue.Queue(maxsize=self._batch_size * 4)
+        self._pending = {
+            DbWriter.PROFILE_URL: [],
+            DbWriter.BOOK_INFO: [],
+            DbWriter.BOOK_URL: [],
+            DbWriter.DOWNLOADED: [],
+        }
+        self._pending_count = 0
+        self._thread = None
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def put(self, kind, item):
+        self._queue.put((kind, item))
+
+
+    def put_profile_urls(self, urls):
+        for url in urls:
+            self.put(DbWriter.PROFILE_URL, url)
+
+
+    def put_book_info(self, book_info):
+        self.put(DbWriter.BOOK_INFO, book_info)
+
+
+    def put_book_url(self, book_url):
+        self.put(DbWriter.BOOK_URL, book_url)
+
+
+    def put_downloaded(self, book_url):
+        self.put(DbWriter.DOWNLOADED, book_url)
+
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put(DbWriter._STOP)
+        self._thread.join()
+        self._thread = None
+
+
+    def _run(self):
+        db = get_db()
+        deadline = time.monotonic() + self._flush_interval
+        while True:
+            try:
+                entry = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                entry = None
+            if entry is DbWriter._STOP:
+                break
+            if entry is not None:
+                kind, item = entry
+                self._pending[kind].append(item)
+                self._pending_count += 1
+            if self._pending_count >= self._batch_size or time.monotonic() >= deadline:
+                self._flush(db)
+                deadline = time.monotonic() + self._flush_interval
+        self._flush(db)
+
+
+    @staticmethod
+    def _write(db, batch):
+        # Book info goes before the book urls, whose rows it creates. The
+        # batch is committed as a whole, or not at all.
+        with metrics.track('db_write'), db.transaction('writer flush', raise_errors=True):
+            db.insert_profile_urls(batch[DbWriter.PROFILE_URL])
+            db.insert_book_info_collection(batch[DbWriter.BOOK_INFO])
+            db.update_book_url_collection(batch[DbWriter.BOOK_URL])
+            db.mark_profile_urls_done(
+                book_info.profile_url for book_info in batch[DbWriter.BOOK_INFO]
+            )
+            db.mark_books_downloaded(
+                book_url.tn_url for book_url in batch[DbWriter.DOWNLOADED]
+            )
+
+
+    def _flush(self, db):
+        if self._pending_count == 0:
+            return
+        metrics.inc(metrics.DB_ROWS_TOTAL, self._pending_count)
+        for attempt in range(1, DbWriter._FLUSH_ATTEMPTS + 1):
+            try:
+                DbWriter._write(db, self._pending)
+                break
+            except Exception as e:
+                DbWriter._LOGGER.warning(f'Db writer flush attempt {attempt} failed: {e}')
+                if attempt < DbWriter._FLUSH_ATTEMPTS:
+                    time.sleep(DbWriter._FLUSH_RETRY_DELAY * 2 ** (attempt - 1))
+        else:
+            self._flush_each(db)
+        for items in self._pending.values():
+            items.clear()
+        self._pending_count = 0
+
+
+    def _flush_each(self, db):
+        # Whatever keeps failing the batch is written item by item, so that
+        # the others still make it. The items that do not are recorded as
+        # failures, their rows are left unfinished for the next run.
+        for kind, items in self._pending.items():
+            for item in items:
+                batch = {pending_kind: [] for pending_kind in self._pending}
+                batch[kind].append(item)
+                try:
+                    DbWriter._write(db, batch)
+                except Exception as e:
+                    stage, key = DbWriter._FAILURE_KEYS[kind]
+                    DbWriter._LOGGER.error(f'Db writer could not write {kind} {key(item)}: {e}')
+                    db.insert_failure(stage, key(item), 1, f'db write: {e}')